@@ -0,0 +1,106 @@
+import ipaddress
+import json
+from urllib.parse import parse_qs, urlsplit
+
+from enums import status, methods
+from classes import request, response
+
+
+def isLoopback(address: str) -> bool:
+    """
+    Check if a client address is on this machine, including IPv4-mapped IPv6 addresses
+    """
+    try:
+        ip = ipaddress.ip_address(address.split("%", 1)[0])
+    except ValueError:
+        return False
+
+    mapped = getattr(ip, "ipv4_mapped", None)
+    return (mapped or ip).is_loopback
+
+
+def jsonResponse(data) -> response.Response:
+    body = json.dumps(data)
+    headers = {
+        "Content-Type": "application/json",
+        "Content-Length": str(len(body)),
+    }
+    return response.Response(**headers, body=body)
+
+
+def notFound() -> response.Response:
+    return response.Response(
+        status_code=status.StatusCode.HTTP_404_NOT_FOUND,
+        status_phrase=status.StatusPhrase.HTTP_404_NOT_FOUND,
+    )
+
+
+def tracesHandler(request: request.Request, query: dict, server) -> response.Response:
+    """
+    List recent traced requests, e.g. traces?min_ms=100&route=test.html&limit=10
+    """
+    if not server.tracer:
+        return notFound()
+
+    spans = server.tracer.query(
+        min_duration_ms=float(query.get("min_ms", 0)),
+        route=query.get("route"),
+        status=int(query["status"]) if "status" in query else None,
+        limit=int(query.get("limit", 100)),
+    )
+    return jsonResponse({"spans": spans})
+
+
+def memoryHandler(request: request.Request, query: dict, server) -> response.Response:
+    """
+    Report RSS, live messages, tracemalloc totals and per-route allocations
+    """
+    if not server.memory:
+        return notFound()
+
+    return jsonResponse(server.memory.summary())
+
+
+def memorySnapshotHandler(
+    request: request.Request, query: dict, server
+) -> response.Response:
+    """
+    Take a tracemalloc snapshot and diff it against the last one
+    e.g. memory/snapshot?limit=10
+    """
+    if not server.memory:
+        return notFound()
+
+    return jsonResponse(server.memory.take_snapshot(limit=int(query.get("limit", 20))))
+
+
+handlers = {
+    "traces": tracesHandler,
+    "memory": memoryHandler,
+    "memory/snapshot": memorySnapshotHandler,
+}
+
+
+def handleAdmin(request: request.Request, server) -> response.Response:
+    # Admin endpoints only report, they never change anything
+    if request.method not in (methods.Methods.HTTP_GET, methods.Methods.HTTP_HEAD):
+        return response.Response(
+            status_code=status.StatusCode.HTTP_400_BAD_REQUEST,
+            status_phrase=status.StatusPhrase.HTTP_400_BAD_REQUEST,
+        )
+
+    url = urlsplit(request.context)
+    path = url.path.split("/", 1)[-1]
+    query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+    handler = handlers.get(path)
+    if not handler:
+        return notFound()
+
+    try:
+        return handler(request, query, server)
+    except ValueError:
+        return response.Response(
+            status_code=status.StatusCode.HTTP_400_BAD_REQUEST,
+            status_phrase=status.StatusPhrase.HTTP_400_BAD_REQUEST,
+        )
@@ -0,0 +1,246 @@
+"""
+Microbenchmarks for message parsing, serialization and utilities
+
+Usage (from src/):
+    python -m benchmarks.micro [--update-baseline] [--tolerance 0.3] [-k NAME]
+
+Each benchmark reports ops/sec and the peak bytes allocated by one call, and is
+compared against benchmarks/baseline.json. The exit status is 1 if any benchmark
+is slower, or allocates more, than the baseline allows.
+NOTE: Baselines are machine-specific, update them on the machine that gates changes
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+import tracemalloc
+
+from classes.request import Request
+from classes.response import Response
+from crud import handleCRUDByMethod
+from enums.methods import Methods
+from enums.status import StatusCode, StatusPhrase
+from utils import DateUtils, FileUtils
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+TEST_FILE = "test.html"
+
+# Headers sent by a typical desktop browser
+BROWSER_HEADERS = (
+    "Host: localhost:9999\r\n"
+    "Connection: keep-alive\r\n"
+    "Cache-Control: max-age=0\r\n"
+    "Upgrade-Insecure-Requests: 1\r\n"
+    "User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36\r\n"
+    "Accept: text/html,application/xhtml+xml,application/xml;q=0.9,"
+    "image/avif,image/webp,*/*;q=0.8\r\n"
+    "Referer: http://localhost:9999/\r\n"
+    "Accept-Encoding: gzip, deflate, br\r\n"
+    "Accept-Language: en-CA,en-US;q=0.9,en;q=0.8\r\n"
+    "If-Modified-Since: Mon, 01 Jan 2024 00:00:00 GMT\r\n"
+)
+
+REQUESTS = {
+    "minimal": "GET / HTTP/1.1\r\n\r\n",
+    "browser": f"GET /test.html HTTP/1.1\r\n{BROWSER_HEADERS}\r\n",
+    "large_body": (
+        "POST / HTTP/1.1\r\n"
+        "Content-Type: text/plain\r\n"
+        "Content-Length: 1048576\r\n"
+        "\r\n" + ("lorem ipsum dolor sit amet\r\n" * 37450)[:1048576]
+    ),
+}
+
+MALFORMED_REQUESTS = [
+    "GET /\r\n\r\n",
+    "GET / HTTP/1.1\r\nHost localhost\r\n\r\n",
+    "\r\n",
+    "GET / HTTP/1.1\r\nA: b: c\r\n\r\n",
+]
+
+
+def parse_malformed():
+    for req in MALFORMED_REQUESTS:
+        try:
+            Request.deserializer(req)
+        except Exception:
+            pass
+
+
+def read_file_body(request: Request) -> None:
+    # The body is read and closed as the server would when sending it
+    body_stream = handleCRUDByMethod(request).body_stream
+    for _ in body_stream:
+        pass
+    body_stream.close()
+
+
+def build_benchmarks() -> dict:
+    """
+    Map benchmark names to zero-argument callables
+    """
+    with open(TEST_FILE, "r", newline="") as f:
+        file_body = f.read()
+
+    last_modified = FileUtils.get_file_last_modified_time_as_string(TEST_FILE)
+
+    ok_response = Response(
+        **{
+            "Content-Type": "text/html",
+            "Content-Length": str(len(file_body)),
+            "Last-Modified": last_modified,
+        },
+        body=file_body,
+    )
+    not_modified_response = Response(
+        status_code=StatusCode.HTTP_304_NOT_MODIFIED,
+        status_phrase=StatusPhrase.HTTP_304_NOT_MODIFIED,
+    )
+    large_response = Response(body=REQUESTS["large_body"].split("\r\n\r\n", 1)[1])
+
+    ok_serialized = str(ok_response)
+    large_serialized = str(large_response)
+
+    root_request = Request()
+    file_request = Request(context=TEST_FILE)
+    head_request = Request(method=Methods.HTTP_HEAD, context=TEST_FILE)
+
+    return {
+        "request_deserializer_minimal": lambda: Request.deserializer(
+            REQUESTS["minimal"]
+        ),
+        "request_deserializer_browser": lambda: Request.deserializer(
+            REQUESTS["browser"]
+        ),
+        "request_deserializer_large_body": lambda: Request.deserializer(
+            REQUESTS["large_body"]
+        ),
+        "request_deserializer_malformed": parse_malformed,
+        "response_serializer_file": ok_response.serializer,
+        "response_serializer_not_modified": not_modified_response.serializer,
+        "response_serializer_large_body": large_response.serializer,
+        "response_deserializer_file": lambda: Response.deserializer(ok_serialized),
+        "response_deserializer_large_body": lambda: Response.deserializer(
+            large_serialized
+        ),
+        "message_iter": lambda: list(ok_response),
+        "get_http_date": lambda: DateUtils.get_http_date(1700000000),
+        "http_date_is_greater_than": lambda: DateUtils.http_date_is_greater_than(
+            last_modified, "Mon, 01 Jan 2024 00:00:00 GMT"
+        ),
+        "get_file_last_modified_time_as_string": lambda: (
+            FileUtils.get_file_last_modified_time_as_string(TEST_FILE)
+        ),
+        "handle_crud_get_root": lambda: handleCRUDByMethod(root_request),
+        "handle_crud_get_file": lambda: read_file_body(file_request),
+        "handle_crud_head_file": lambda: handleCRUDByMethod(head_request),
+    }
+
+
+def measure(func, min_time: float, repeat: int) -> dict:
+    """
+    Measure ops/sec with timeit and the peak bytes allocated by a single call
+    """
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    number = max(1, int(number * min_time / 0.2))
+
+    # The fastest repeat is the least disturbed by the rest of the machine
+    best = min(timer.repeat(repeat=repeat, number=number))
+
+    # Warm up caches so only the steady state allocations are counted
+    func()
+    tracemalloc.start()
+    try:
+        before, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {"ops_per_sec": round(number / best), "peak_bytes": max(0, peak - before)}
+
+
+def compare(name: str, result: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Describe how a result regressed against its baseline, if it did
+    """
+    if name not in baseline:
+        return []
+
+    expected = baseline[name]
+    regressions = []
+
+    if result["ops_per_sec"] < expected["ops_per_sec"] * (1 - tolerance):
+        regressions.append(
+            f"ops/sec {result['ops_per_sec']:,.0f} < {expected['ops_per_sec']:,.0f}"
+        )
+
+    # Allow a little slack for small allocations that vary between runs
+    if result["peak_bytes"] > expected["peak_bytes"] * (1 + tolerance) + 512:
+        regressions.append(
+            f"peak bytes {result['peak_bytes']:,} > {expected['peak_bytes']:,}"
+        )
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.3)
+    parser.add_argument("--min-time", type=float, default=0.1)
+    parser.add_argument("--repeat", type=int, default=7)
+    parser.add_argument("-k", "--filter", default="")
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+
+    results = {}
+    failed = False
+
+    print(f"{'benchmark':<40} {'ops/sec':>14} {'peak B/op':>12}  vs baseline")
+    for name, func in build_benchmarks().items():
+        if args.filter not in name:
+            continue
+
+        result = measure(func, args.min_time, args.repeat)
+        results[name] = result
+
+        regressions = compare(name, result, baseline, args.tolerance)
+        failed = failed or bool(regressions)
+
+        if name in baseline:
+            change = result["ops_per_sec"] / baseline[name]["ops_per_sec"] - 1
+            status = f"{change:+.1%}" + (
+                f"  REGRESSION: {'; '.join(regressions)}" if regressions else ""
+            )
+        else:
+            status = "new"
+
+        print(
+            f"{name:<40} {result['ops_per_sec']:>14,.0f} "
+            f"{result['peak_bytes']:>12,}  {status}"
+        )
+
+    if args.update_baseline:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
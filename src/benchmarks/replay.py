@@ -0,0 +1,254 @@
+"""
+Replay captured traffic against a server and report latency and status differences
+
+Usage (from src/):
+    python -m benchmarks.replay CAPTURE [--speed 2] [--max-speed] [-c CONNECTIONS]
+
+Capture traffic first with: python server.py --capture capture.jsonl
+Requests are sent at their captured times divided by --speed, or as fast as possible
+with --max-speed, over a fixed number of persistent connections.
+"""
+
+import argparse
+import base64
+import queue
+import socket
+import statistics
+import threading
+import time
+from collections import Counter
+
+from capture import load_capture
+from proxy import receiveHead
+from server import ServerDetails
+
+
+def encode(record: dict) -> bytes:
+    """
+    Rebuild the raw request, padding bodies that were cut short when captured
+    """
+    body = base64.b64decode(record["body"])
+    body += b"x" * (record["body_length"] - len(body))
+    return bytes(record["head"], "ascii") + b"\r\n\r\n" + body
+
+
+class Connection:
+    """
+    A persistent client connection, reopened whenever the server closes it
+    """
+
+    def __init__(self, address: tuple, timeout: float) -> None:
+        self.address = address
+        self.timeout = timeout
+        self.sock = None
+
+    def send(self, payload: bytes, is_head: bool) -> int:
+        """
+        Send a request and read the whole response
+        Returns the response status code
+        """
+        for attempt in range(2):
+            if not self.sock:
+                self.sock = socket.create_connection(self.address, timeout=self.timeout)
+
+            try:
+                self.sock.sendall(payload)
+                head, buffered = receiveHead(self.sock, 64 * 1024, 64 * 1024)
+                break
+            except ConnectionError:
+                # The server closed an idle connection, retry once on a new one
+                self.close()
+                if attempt:
+                    raise
+
+        code, headers = self.parse(head)
+
+        # Interim responses, e.g. 100 Continue for a captured Expect header, come first
+        while code < 200:
+            head, buffered = receiveHead(self.sock, 64 * 1024, 64 * 1024, buffered)
+            code, headers = self.parse(head)
+
+        if is_head or code in (204, 304):
+            remaining = 0
+        elif "content-length" in headers:
+            remaining = int(headers["content-length"]) - len(buffered)
+        else:
+            # The body ends when the server closes the connection
+            remaining = float("inf")
+
+        while remaining > 0:
+            chunk = self.sock.recv(64 * 1024)
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+        if remaining or headers.get("connection", "").lower() == "close":
+            self.close()
+
+        return code
+
+    @staticmethod
+    def parse(head: str) -> tuple:
+        """
+        Get the status code and the lower-cased headers of a response
+        """
+        status_line, *header_lines = head.split("\r\n")
+        code = int(status_line.split(None, 2)[1])
+        headers = {
+            k.strip().lower(): v.strip()
+            for k, _, v in (line.partition(":") for line in header_lines)
+        }
+        return code, headers
+
+    def close(self) -> None:
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+
+def worker(address: tuple, timeout: float, jobs: queue.Queue, results: list) -> None:
+    connection = Connection(address, timeout)
+
+    while True:
+        job = jobs.get()
+        if job is None:
+            break
+
+        record, payload = job
+        start = time.perf_counter_ns()
+        try:
+            status = connection.send(payload, record["head"].startswith("HEAD "))
+        except Exception:
+            # Counted as a difference, the replay goes on with a new connection
+            status = None
+            connection.close()
+
+        results.append(
+            {
+                "route": record["head"].split(" ", 2)[1],
+                "captured_status": record["status"],
+                "status": status,
+                "latency_ns": time.perf_counter_ns() - start,
+            }
+        )
+
+    connection.close()
+
+
+def replay(
+    records: list,
+    address: tuple,
+    speed: float = 1.0,
+    max_speed: bool = False,
+    connections: int = 8,
+    timeout: float = 30,
+) -> tuple:
+    """
+    Send the captured requests, following their original timing scaled by speed
+    Returns the result of each request and the total elapsed seconds
+    """
+    jobs = queue.Queue(maxsize=connections * 4)
+    results = []
+    workers = [
+        threading.Thread(target=worker, args=(address, timeout, jobs, results))
+        for _ in range(connections)
+    ]
+    for thread in workers:
+        thread.start()
+
+    payloads = [(record, encode(record)) for record in records]
+    first_t = records[0]["t"] if records else 0
+    start = time.perf_counter()
+
+    for record, payload in payloads:
+        if not max_speed:
+            due = (record["t"] - first_t) / 1e9 / speed
+            delay = due - (time.perf_counter() - start)
+            if delay > 0:
+                time.sleep(delay)
+        jobs.put((record, payload))
+
+    for _ in workers:
+        jobs.put(None)
+    for thread in workers:
+        thread.join()
+
+    return results, time.perf_counter() - start
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def summarize(results: list, elapsed: float) -> dict:
+    latencies_ms = sorted(r["latency_ns"] / 1e6 for r in results)
+    differences = Counter(
+        (r["route"], r["captured_status"], r["status"])
+        for r in results
+        if r["status"] != r["captured_status"]
+    )
+
+    return {
+        "requests": len(results),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(results) / elapsed if elapsed else 0,
+        "latency_ms": {
+            "mean": statistics.mean(latencies_ms) if latencies_ms else 0,
+            "p50": percentile(latencies_ms, 0.5) if latencies_ms else 0,
+            "p90": percentile(latencies_ms, 0.9) if latencies_ms else 0,
+            "p99": percentile(latencies_ms, 0.99) if latencies_ms else 0,
+            "max": latencies_ms[-1] if latencies_ms else 0,
+        },
+        "statuses": Counter(r["status"] for r in results),
+        "differences": differences,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("capture")
+    parser.add_argument("--host", default=ServerDetails.host)
+    parser.add_argument("--port", type=int, default=ServerDetails.port)
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--max-speed", action="store_true")
+    parser.add_argument("-c", "--connections", type=int, default=8)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    records = load_capture(args.capture)
+    results, elapsed = replay(
+        records,
+        (args.host, args.port),
+        args.speed,
+        args.max_speed,
+        args.connections,
+        args.timeout,
+    )
+    summary = summarize(results, elapsed)
+
+    print(
+        f"{summary['requests']} requests in {summary['elapsed_s']:.2f} s "
+        f"({summary['throughput_rps']:.0f} req/s)"
+    )
+    print(
+        "latency ms: "
+        + "  ".join(f"{k} {v:.2f}" for k, v in summary["latency_ms"].items())
+    )
+    print(
+        "statuses: "
+        + ", ".join(
+            f"{k}: {v}" for k, v in sorted(summary["statuses"].items(), key=str)
+        )
+    )
+
+    if summary["differences"]:
+        print("status differences (route: captured -> replayed):")
+        for (route, captured, replayed), count in summary["differences"].most_common():
+            print(f"  {route}: {captured} -> {replayed}  x{count}")
+    else:
+        print("no status differences")
+
+
+if __name__ == "__main__":
+    main()
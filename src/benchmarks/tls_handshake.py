@@ -0,0 +1,94 @@
+"""
+Compare the cost of full and resumed TLS handshakes against a local server
+
+Usage (from src/): python -m benchmarks.tls_handshake [-n ITERATIONS]
+"""
+
+import argparse
+import os
+import socket
+import ssl
+import statistics
+import tempfile
+import threading
+import time
+
+from classes.request import Request
+from server import ThreadedTCPServer, ThreadedTCPRequestHandler
+from tls import TLSConfig, create_self_signed_certificate
+
+
+def handshake(address, context, session=None):
+    """
+    Connect, handshake and make one request
+    Returns the handshake time in seconds, the TLS session and whether it was reused
+    """
+    start = time.perf_counter()
+    raw = socket.create_connection(address)
+    sock = context.wrap_socket(raw, server_hostname="localhost", session=session)
+    elapsed = time.perf_counter() - start
+
+    # TLS 1.3 tickets arrive after the handshake, so read a response before saving
+    # the session
+    sock.sendall(bytes(str(Request()), "ascii"))
+    sock.recv(1024)
+    reused = sock.session_reused
+    new_session = sock.session
+
+    sock.close()
+    return elapsed, new_session, reused
+
+
+def summarize(label, samples):
+    samples_ms = sorted(s * 1000 for s in samples)
+    p99 = samples_ms[min(len(samples_ms) - 1, int(len(samples_ms) * 0.99))]
+    print(
+        f"{label:<8} mean {statistics.mean(samples_ms):7.3f} ms  "
+        f"p50 {statistics.median(samples_ms):7.3f} ms  p99 {p99:7.3f} ms"
+    )
+    return statistics.mean(samples_ms)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("-n", "--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        certfile = os.path.join(directory, "cert.pem")
+        keyfile = os.path.join(directory, "key.pem")
+        create_self_signed_certificate(certfile, keyfile)
+
+        tls = TLSConfig(certfile, keyfile)
+        server = ThreadedTCPServer(("localhost", 0), ThreadedTCPRequestHandler, tls=tls)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        context = ssl.create_default_context(cafile=certfile)
+        context.set_alpn_protocols(["http/1.1"])
+
+        full, resumed = [], []
+        reused_count = 0
+        _, session, _ = handshake(server.server_address, context)
+
+        for _ in range(args.iterations):
+            elapsed, _, _ = handshake(server.server_address, context)
+            full.append(elapsed)
+
+            elapsed, session, reused = handshake(
+                server.server_address, context, session
+            )
+            resumed.append(elapsed)
+            reused_count += reused
+
+        server.shutdown()
+        server.server_close()
+
+    print(f"{args.iterations} handshakes each ({ssl.OPENSSL_VERSION})")
+    full_mean = summarize("full", full)
+    resumed_mean = summarize("resumed", resumed)
+    print(f"resumed sessions: {reused_count}/{args.iterations}")
+    print(f"speedup: {full_mean / resumed_mean:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
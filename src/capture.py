@@ -0,0 +1,67 @@
+import base64
+import json
+import threading
+import time
+
+
+class TrafficCapture:
+    """
+    Records requests as JSON lines, for replaying with benchmarks/replay.py
+    Each line holds the arrival time since capture started, the raw start line and
+    headers, the body (base64, cut at max_body bytes), and the status and latency served
+    """
+
+    def __init__(self, path: str, max_body: int = 64 * 1024) -> None:
+        self.path = path
+        self.max_body = max_body
+        self.started_ns = time.monotonic_ns()
+
+        # Times are relative to this run, so records from an earlier run are replaced
+        self.file = open(path, "w", buffering=1)
+        self.lock = threading.Lock()
+
+    def record(
+        self,
+        arrived_ns: int,
+        client_address: tuple,
+        head: str,
+        body_stream,
+        body_length: int,
+        status: int,
+    ) -> None:
+        body = b""
+        if body_stream and body_length:
+            # The handler may have read the body already
+            position = body_stream.tell()
+            body_stream.seek(0)
+            body = body_stream.read(self.max_body)
+            body_stream.seek(position)
+
+        line = json.dumps(
+            {
+                "t": arrived_ns - self.started_ns,
+                "client": client_address[0],
+                "head": head,
+                "body": base64.b64encode(body).decode("ascii"),
+                "body_length": body_length,
+                "status": status,
+                "duration_ns": time.monotonic_ns() - arrived_ns,
+            },
+            separators=(",", ":"),
+        )
+
+        with self.lock:
+            self.file.write(line + "\n")
+
+    def close(self) -> None:
+        with self.lock:
+            self.file.close()
+
+
+def load_capture(path: str) -> list:
+    """
+    Read captured requests, in arrival order
+    """
+    with open(path, "r") as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return sorted(records, key=lambda record: record["t"])
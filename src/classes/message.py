@@ -1,4 +1,4 @@
-from typing import Any
+from typing import Any, Optional
 
 
 class HTTPMessage:
@@ -17,6 +17,10 @@ class HTTPMessage:
         # Body
         self.body: Any = kwargs.get("body", None)
 
+        # Headers as received, (name, value) pairs in their original order and case
+        # NOTE: Set by deserializer, so headers without an attribute aren't lost
+        self.headers: Optional[list] = None
+
     def __str__(self) -> str:
         return self.serializer()
 
@@ -30,3 +34,26 @@ class HTTPMessage:
     @staticmethod
     def deserializer():
         raise NotImplementedError
+
+    @staticmethod
+    def parse_headers(lines: list) -> list:
+        """
+        Split header lines into (name, value) pairs
+        """
+        headers = []
+        for line in lines:
+            name, separator, value = line.partition(":")
+            if not separator or not name.strip():
+                raise ValueError(f"Malformed header: {line}")
+            headers.append((name.strip(), value.strip()))
+        return headers
+
+    def get_header(self, name: str, default: str = "") -> str:
+        """
+        Get the first received value of a header, ignoring case
+        """
+        name = name.lower()
+        for k, v in self.headers or ():
+            if k.lower() == name:
+                return v
+        return default
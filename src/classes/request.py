@@ -28,6 +28,13 @@ class Request(HTTPMessage):
         self.cache_control: str = kwargs.get("Cache-Control", "")
         self.content_type: str = kwargs.get("Content-Type", "")
         self.content_length: str = kwargs.get("Content-Length", 0)
+        self.expect: str = kwargs.get("Expect", "")
+
+        # File-like request body, set by the server once the body is received
+        self.body_stream = kwargs.get("body_stream", None)
+
+        # Virtual host serving the request, set by the server from the Host header
+        self.vhost = kwargs.get("vhost", None)
 
     def serializer(self) -> str:
         # First line must be in the form <method> <context> <version>
@@ -38,15 +45,24 @@ class Request(HTTPMessage):
 
         # Subsequent lines must be headers in the form <header-name>: <header-value>
         for k, v in self:
-            if v and k not in ("method", "context", "version", "body"):
+            if v and k not in (
+                "method",
+                "context",
+                "version",
+                "body",
+                "body_stream",
+                "vhost",
+                "headers",
+            ):
                 k_formatted = "-".join(
                     [k_entry.capitalize() for k_entry in k.split("_")]
                 )
                 request_str += f"{k_formatted}: {v}\r\n"
 
-        # Lastly, append the body (without the header name)
+        # Headers end with an empty line, then the body (without the header name)
+        request_str += "\r\n"
         if self.body:
-            request_str += f"\r\n{self.body}\r\n"
+            request_str += f"{self.body}"
 
         return request_str
 
@@ -54,7 +70,7 @@ class Request(HTTPMessage):
     def deserializer(req) -> "Request":
         tokens = req.splitlines()
         method, context, version = tokens.pop(0).split()
-        headers = {}
+        headers = []
         body = ""
 
         try:
@@ -73,12 +89,14 @@ class Request(HTTPMessage):
                 body_start = tokens.index("")
             except ValueError:
                 # No body, everything must be headers
-                headers = dict([h.split(": ") for h in tokens])
+                headers = HTTPMessage.parse_headers(tokens)
             else:
                 # Request contains a body, parse headers and body accordingly
-                headers = dict([h.split(": ") for h in tokens[:body_start:]])
+                headers = HTTPMessage.parse_headers(tokens[:body_start:])
                 body = "\r\n".join(tokens[body_start + 1 : :])
 
-        return Request(
-            method=method, context=context, version=version, body=body, **headers
+        deserialized = Request(
+            method=method, context=context, version=version, body=body, **dict(headers)
         )
+        deserialized.headers = headers
+        return deserialized
@@ -23,17 +23,22 @@ class Response(HTTPMessage):
             "Access-Control-Allow-Origin", ""
         )
         self.content_encoding: str = kwargs.get("Content-Encoding", "")
+        self.content_length: str = kwargs.get("Content-Length", "")
         self.content_type: str = kwargs.get("Content-Type", "text/plain")
         self.date: str = kwargs.get("Date", DateUtils.get_http_date())
         self.etag: str = kwargs.get("ETag", "")
         self.expires: str = kwargs.get("Expires", "")
         self.keep_alive: str = kwargs.get("Keep-Alive", "")
         self.last_modified: str = kwargs.get("Last-Modified", "")
+        self.retry_after: str = kwargs.get("Retry-After", "")
         self.server: str = kwargs.get("Server", "MP Web Server")
         self.set_cookie: str = kwargs.get("Set-Cookie", "")
         self.transfer_encoding: str = kwargs.get("Transfer-Encoding", "")
         self.vary: str = kwargs.get("Vary", "")
 
+        # Iterable of body chunks, sent after the headers instead of body
+        self.body_stream = kwargs.get("body_stream", None)
+
     def serializer(self) -> str:
         # First line must be the status line in the form <version> <status-code> <status-phrase>
         response_str = (
@@ -42,15 +47,26 @@ class Response(HTTPMessage):
 
         # Subsequent lines must be headers in the form <header-name>: <header-value>
         for k, v in self:
-            if v and (k not in ("version", "status_code", "status_phrase", "body")):
+            if v and (
+                k
+                not in (
+                    "version",
+                    "status_code",
+                    "status_phrase",
+                    "body",
+                    "body_stream",
+                    "headers",
+                )
+            ):
                 k_formatted = "-".join(
                     [k_entry.capitalize() for k_entry in k.split("_")]
                 )
                 response_str += f"{k_formatted}: {v}\r\n"
 
-        # Lastly, append the body (without the header name)
+        # Headers end with an empty line, then the body (without the header name)
+        response_str += "\r\n"
         if self.body:
-            response_str += f"\r\n{self.body}\r\n"
+            response_str += f"{self.body}"
 
         return response_str
 
@@ -61,7 +77,7 @@ class Response(HTTPMessage):
         version = start_line[0]
         code = start_line[1]
         phrase = " ".join(start_line[2::])
-        headers = {}
+        headers = []
         body = ""
 
         if tokens:
@@ -70,16 +86,18 @@ class Response(HTTPMessage):
                 body_start = tokens.index("")
             except ValueError:
                 # No body, everything must be headers
-                headers = dict([h.split(": ") for h in tokens])
+                headers = HTTPMessage.parse_headers(tokens)
             else:
                 # Request contains a body, parse headers and body accordingly
-                headers = dict([h.split(": ") for h in tokens[:body_start:]])
+                headers = HTTPMessage.parse_headers(tokens[:body_start:])
                 body = "\r\n".join(tokens[body_start + 1 : :])
 
-        return Response(
+        deserialized = Response(
             version=version,
             status_code=StatusCode(int(code)),
             status_phrase=StatusPhrase(phrase),
             body=body,
-            **headers,
+            **dict(headers),
         )
+        deserialized.headers = headers
+        return deserialized
@@ -1,9 +1,27 @@
+import os
+import stat
+from typing import Optional
+
 from enums import status, methods
 from classes import request, response
-from utils import DateUtils, FileUtils
+from utils import DateUtils, FileBody, FileMetadataCache
 
 
-def createHandler(request: request.Request) -> response.Response:
+def resolvePath(request: request.Request) -> Optional[str]:
+    """
+    Get the file a request refers to, under its virtual host's document root if any
+    Returns None if the file would be outside the document root
+    """
+    if not request.vhost:
+        return request.context
+    return request.vhost.resolve(request.context)
+
+
+def createValidator(request: request.Request) -> Optional[response.Response]:
+    """
+    Check a create request before its body is received
+    Returns the rejection response, or None if the request is acceptable
+    """
     if not request.content_type:
         return response.Response(
             status_code=status.StatusCode.HTTP_400_BAD_REQUEST,
@@ -17,6 +35,14 @@ def createHandler(request: request.Request) -> response.Response:
             status_phrase=status.StatusPhrase.HTTP_411_LENGTH_REQUIRED,
         )
 
+    return None
+
+
+def createHandler(request: request.Request) -> response.Response:
+    rejection = createValidator(request)
+    if rejection:
+        return rejection
+
     # Not actually creating anything
 
     # Mock OK response
@@ -33,45 +59,80 @@ def readHandler(request: request.Request) -> response.Response:
     includes_body = request.method == methods.Methods.HTTP_GET
 
     if request.context == "/":
+        body = "hello :)"
+        headers = {
+            "Content-Length": str(len(body)),
+        }
         if includes_body:
-            headers = {
-                "Content-Type": "application/json",
-            }
-            return response.Response(body="hello :)")
-        return response.Response()
+            return response.Response(**headers, body=body)
+        return response.Response(**headers)
     elif request.context == "delay":
         import time
 
         time.sleep(2)
         return response.Response(body="delay")
 
-    # Only serve HTML, anything else is forbidden
-    if not request.context.endswith("html"):
+    path = resolvePath(request)
+
+    # Only serve HTML inside the document root, anything else is forbidden
+    if not request.context.endswith("html") or not path:
         return response.Response(
             status_code=status.StatusCode.HTTP_403_FORBIDDEN,
             status_phrase=status.StatusPhrase.HTTP_403_FORBIDDEN,
         )
 
+    try:
+        # Decide the response from file metadata alone, the file is only read for a body
+        file_stat = FileMetadataCache.stat(
+            path, request.vhost.name if request.vhost else ""
+        )
+    except FileNotFoundError:
+        # File not found, return 404
+        return response.Response(
+            status_code=status.StatusCode.HTTP_404_NOT_FOUND,
+            status_phrase=status.StatusPhrase.HTTP_404_NOT_FOUND,
+        )
+    except Exception:
+        # Some other exception occurred, return 400
+        return response.Response(
+            status_code=status.StatusCode.HTTP_400_BAD_REQUEST,
+            status_phrase=status.StatusPhrase.HTTP_400_BAD_REQUEST,
+        )
+
+    # Directories and other special files can't be served
+    if not stat.S_ISREG(file_stat.st_mode):
+        return response.Response(
+            status_code=status.StatusCode.HTTP_400_BAD_REQUEST,
+            status_phrase=status.StatusPhrase.HTTP_400_BAD_REQUEST,
+        )
+
     headers = {
         "Content-Type": "text/html",
+        "Content-Length": str(file_stat.st_size),
+        "Last-Modified": DateUtils.get_http_date(file_stat.st_mtime),
     }
-    body = None
+
+    # If cache header specified, check if cached object should be used
+    if request.if_modified_since and not DateUtils.http_date_is_greater_than(
+        headers["Last-Modified"],
+        request.if_modified_since,
+    ):
+        # Not modified, return 304
+        return response.Response(
+            status_code=status.StatusCode.HTTP_304_NOT_MODIFIED,
+            status_phrase=status.StatusPhrase.HTTP_304_NOT_MODIFIED,
+        )
+
+    if not includes_body:
+        return response.Response(**headers)
 
     try:
-        # Try to serve the requested context (file)
-        with open(request.context, "r") as f:
-            headers.update(
-                {
-                    "Last-Modified": FileUtils.get_file_last_modified_time_as_string(
-                        f.name
-                    )
-                }
-            )
-
-            body = str(f.read())
+        # Send the bytes as they are on disk, so the length matches HEAD's st_size
+        # NOTE: Unbuffered, reads are chunk-sized so a buffer would only add a copy
+        f = open(path, "rb", buffering=0)
 
     except FileNotFoundError:
-        # File not found, return 404
+        # File removed since it was checked, return 404
         return response.Response(
             status_code=status.StatusCode.HTTP_404_NOT_FOUND,
             status_phrase=status.StatusPhrase.HTTP_404_NOT_FOUND,
@@ -82,35 +143,20 @@ def readHandler(request: request.Request) -> response.Response:
             status_code=status.StatusCode.HTTP_400_BAD_REQUEST,
             status_phrase=status.StatusPhrase.HTTP_400_BAD_REQUEST,
         )
-    else:
-        # If cache header unspecified, return object with OK
-        if not request.if_modified_since:
-            return (
-                response.Response(**headers, body=body)
-                if includes_body
-                else response.Response(**headers)
-            )
-
-        # Otherwise, check if cached object should be used
-        else:
-            if DateUtils.http_date_is_greater_than(
-                headers["Last-Modified"],
-                request.if_modified_since,
-            ):
-                return (
-                    response.Response(**headers, body=body)
-                    if includes_body
-                    else response.Response(**headers)
-                )
-            else:
-                # Not modified, return 304
-                return response.Response(
-                    status_code=status.StatusCode.HTTP_304_NOT_MODIFIED,
-                    status_phrase=status.StatusPhrase.HTTP_304_NOT_MODIFIED,
-                )
 
+    # The file may have changed since it was checked
+    length = os.fstat(f.fileno()).st_size
+    headers["Content-Length"] = str(length)
 
-def updateHandler(request: request.Request) -> response.Response:
+    # Streamed in chunks, so large files aren't held in memory
+    return response.Response(**headers, body_stream=FileBody(f, length))
+
+
+def updateValidator(request: request.Request) -> Optional[response.Response]:
+    """
+    Check an update request before its body is received
+    Returns the rejection response, or None if the request is acceptable
+    """
     if not request.content_type or not request.context:
         return response.Response(
             status_code=status.StatusCode.HTTP_400_BAD_REQUEST,
@@ -124,8 +170,10 @@ def updateHandler(request: request.Request) -> response.Response:
             status_phrase=status.StatusPhrase.HTTP_411_LENGTH_REQUIRED,
         )
 
-    # Only allow access to HTML, anything else is forbidden
-    if not request.context.endswith("html"):
+    path = resolvePath(request)
+
+    # Only allow access to HTML inside the document root, anything else is forbidden
+    if not request.context.endswith("html") or not path:
         return response.Response(
             status_code=status.StatusCode.HTTP_403_FORBIDDEN,
             status_phrase=status.StatusPhrase.HTTP_403_FORBIDDEN,
@@ -133,7 +181,7 @@ def updateHandler(request: request.Request) -> response.Response:
 
     try:
         # Try to open the file
-        with open(request.context, "r"):
+        with open(path, "r"):
             pass
 
     except FileNotFoundError:
@@ -149,6 +197,14 @@ def updateHandler(request: request.Request) -> response.Response:
             status_phrase=status.StatusPhrase.HTTP_400_BAD_REQUEST,
         )
 
+    return None
+
+
+def updateHandler(request: request.Request) -> response.Response:
+    rejection = updateValidator(request)
+    if rejection:
+        return rejection
+
     # Not actually updating anything
 
     # Mock OK response
@@ -162,8 +218,10 @@ def deleteHandler(request: request.Request) -> response.Response:
             status_phrase=status.StatusPhrase.HTTP_400_BAD_REQUEST,
         )
 
-    # Only allow access to HTML, anything else is forbidden
-    if not request.context.endswith("html"):
+    path = resolvePath(request)
+
+    # Only allow access to HTML inside the document root, anything else is forbidden
+    if not request.context.endswith("html") or not path:
         return response.Response(
             status_code=status.StatusCode.HTTP_403_FORBIDDEN,
             status_phrase=status.StatusPhrase.HTTP_403_FORBIDDEN,
@@ -171,7 +229,7 @@ def deleteHandler(request: request.Request) -> response.Response:
 
     try:
         # Try to open the file
-        with open(request.context, "r"):
+        with open(path, "r"):
             pass
 
     except FileNotFoundError:
@@ -201,6 +259,21 @@ handlers = {
     methods.Methods.HTTP_DELETE: deleteHandler,
 }
 
+# Checks that can run before a request body is received, e.g. for Expect: 100-continue
+validators = {
+    methods.Methods.HTTP_POST: createValidator,
+    methods.Methods.HTTP_PUT: updateValidator,
+}
+
 
 def handleCRUDByMethod(request: request.Request) -> response.Response:
+    # Routes of the request's virtual host take precedence
+    if request.vhost and request.context in request.vhost.routes:
+        return request.vhost.routes[request.context](request)
+
     return handlers[request.method](request)
+
+
+def validateCRUDByMethod(request: request.Request) -> Optional[response.Response]:
+    validator = validators.get(request.method)
+    return validator(request) if validator else None
@@ -2,20 +2,34 @@ from enum import Enum
 
 
 class StatusCode(Enum):
+    HTTP_100_CONTINUE = 100
     HTTP_200_OK = 200
+    HTTP_204_NO_CONTENT = 204
     HTTP_304_NOT_MODIFIED = 304
     HTTP_400_BAD_REQUEST = 400
     HTTP_403_FORBIDDEN = 403
     HTTP_404_NOT_FOUND = 404
     HTTP_411_LENGTH_REQUIRED = 411
+    HTTP_413_PAYLOAD_TOO_LARGE = 413
+    HTTP_429_TOO_MANY_REQUESTS = 429
     HTTP_500_INTERNAL_SERVER_ERROR = 500
+    HTTP_502_BAD_GATEWAY = 502
+    HTTP_503_SERVICE_UNAVAILABLE = 503
+    HTTP_504_GATEWAY_TIMEOUT = 504
 
 
 class StatusPhrase(Enum):
+    HTTP_100_CONTINUE = "Continue"
     HTTP_200_OK = "OK"
+    HTTP_204_NO_CONTENT = "No Content"
     HTTP_304_NOT_MODIFIED = "Not Modified"
     HTTP_400_BAD_REQUEST = "Bad Request"
     HTTP_403_FORBIDDEN = "Forbidden"
     HTTP_404_NOT_FOUND = "Not Found"
     HTTP_411_LENGTH_REQUIRED = "Length Required"
+    HTTP_413_PAYLOAD_TOO_LARGE = "Payload Too Large"
+    HTTP_429_TOO_MANY_REQUESTS = "Too Many Requests"
     HTTP_500_INTERNAL_SERVER_ERROR = "Internal Server Error"
+    HTTP_502_BAD_GATEWAY = "Bad Gateway"
+    HTTP_503_SERVICE_UNAVAILABLE = "Service Unavailable"
+    HTTP_504_GATEWAY_TIMEOUT = "Gateway Timeout"
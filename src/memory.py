@@ -0,0 +1,183 @@
+import gc
+import os
+import random
+import sys
+import threading
+import tracemalloc
+
+from classes.request import Request
+from classes.response import Response
+
+
+class MemoryDiagnostics:
+    """
+    Tracks memory use of the request pipeline
+    NOTE: tracemalloc's peak is process-wide, so only one request is sampled at a time,
+    allocations by other threads while it runs are still counted toward it
+    """
+
+    # Routes past this many are counted together, so scans for missing files don't
+    # grow the table
+    max_routes = 256
+
+    def __init__(self, sample_rate: float = 0.01, frames: int = 1) -> None:
+        self.sample_rate = sample_rate
+        self.frames = frames
+
+        # Route -> [sampled requests, total bytes, max bytes]
+        self.routes = {}
+        self.lock = threading.Lock()
+        self.snapshot = None
+
+        # Held by the request being sampled
+        self.sampling = threading.Lock()
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        self.snapshot = None
+
+    def begin_request(self):
+        """
+        Decide whether to sample a request, requests overlapping a sampled one aren't
+        Returns the traced memory at the start of the request, or None if not sampled
+        """
+        if not tracemalloc.is_tracing() or random.random() >= self.sample_rate:
+            return None
+
+        # Resetting the peak would spoil the measurement of the request being sampled
+        if not self.sampling.acquire(blocking=False):
+            return None
+
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def end_request(self, route: str, started_with: int) -> None:
+        """
+        Account the peak memory the request allocated on top of what was in use
+        NOTE: Must be called for every request begin_request() sampled
+        """
+        peak = tracemalloc.get_traced_memory()[1]
+        self.sampling.release()
+
+        if not tracemalloc.is_tracing():
+            return
+
+        allocated = max(0, peak - started_with)
+        route = route.split("?", 1)[0]
+
+        with self.lock:
+            if route not in self.routes and len(self.routes) >= self.max_routes:
+                route = "<other>"
+
+            stats = self.routes.setdefault(route, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += allocated
+            stats[2] = max(stats[2], allocated)
+
+    def route_stats(self) -> dict:
+        with self.lock:
+            return {
+                route: {
+                    "sampled": count,
+                    "mean_bytes": total // count,
+                    "max_bytes": largest,
+                }
+                for route, (count, total, largest) in self.routes.items()
+            }
+
+    @staticmethod
+    def resident_set_size() -> dict:
+        """
+        Get the current and peak resident set size in bytes
+        """
+        sizes = {"rss_bytes": None, "peak_rss_bytes": None}
+
+        try:
+            with open("/proc/self/statm", "r") as f:
+                sizes["rss_bytes"] = int(f.read().split()[1]) * os.sysconf(
+                    "SC_PAGE_SIZE"
+                )
+        except (OSError, ValueError, IndexError):
+            pass
+
+        try:
+            import resource
+
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Reported in kilobytes on Linux, bytes on macOS
+            sizes["peak_rss_bytes"] = peak if sys.platform == "darwin" else peak * 1024
+        except ImportError:
+            pass
+
+        return sizes
+
+    @staticmethod
+    def live_messages() -> dict:
+        """
+        Count Request and Response objects still alive
+        NOTE: Scans every object tracked by gc, only call on demand
+        """
+        counts = {"requests": 0, "responses": 0}
+        for obj in gc.get_objects():
+            if isinstance(obj, Request):
+                counts["requests"] += 1
+            elif isinstance(obj, Response):
+                counts["responses"] += 1
+        return counts
+
+    def summary(self) -> dict:
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            **self.resident_set_size(),
+            "live": self.live_messages(),
+            "tracemalloc": {
+                "tracing": tracemalloc.is_tracing(),
+                "current_bytes": current,
+                "peak_bytes": peak,
+            },
+            "routes": self.route_stats(),
+        }
+
+    def take_snapshot(self, limit: int = 20) -> dict:
+        """
+        Take a tracemalloc snapshot and compare it with the previous one
+        The first call starts tracing if needed, and has nothing to compare with
+        """
+        self.start()
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [
+                tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            ]
+        )
+        previous, self.snapshot = self.snapshot, snapshot
+
+        if previous:
+            stats = snapshot.compare_to(previous, "lineno")[:limit]
+            top = [
+                {
+                    "location": str(stat.traceback),
+                    "size_bytes": stat.size,
+                    "size_diff_bytes": stat.size_diff,
+                    "count": stat.count,
+                    "count_diff": stat.count_diff,
+                }
+                for stat in stats
+            ]
+        else:
+            stats = snapshot.statistics("lineno")[:limit]
+            top = [
+                {
+                    "location": str(stat.traceback),
+                    "size_bytes": stat.size,
+                    "count": stat.count,
+                }
+                for stat in stats
+            ]
+
+        return {"compared": previous is not None, "top": top}
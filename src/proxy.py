@@ -0,0 +1,644 @@
+import itertools
+import socket
+import threading
+import time
+from collections import deque
+
+from enums import status, methods
+from classes import request, response
+from classes.message import HTTPMessage
+
+# Headers that only apply to a single connection, so are never forwarded
+hop_by_hop_headers = frozenset(
+    (
+        "connection",
+        "keep-alive",
+        "proxy-authenticate",
+        "proxy-authorization",
+        "te",
+        "trailer",
+        "transfer-encoding",
+        "upgrade",
+    )
+)
+
+
+def endToEndHeaders(headers: list, exclude: tuple = ()) -> list:
+    """
+    Drop hop-by-hop headers, including any named by the Connection header
+    """
+    dropped = set(hop_by_hop_headers).union(exclude)
+    for name, value in headers:
+        if name.lower() == "connection":
+            dropped.update(token.strip().lower() for token in value.split(","))
+
+    return [(name, value) for name, value in headers if name.lower() not in dropped]
+
+
+def receiveHead(
+    sock: socket.socket, recv_size: int, max_head_size: int, received: bytes = b""
+) -> tuple:
+    """
+    Receive until the empty line that ends the headers, after any bytes already received
+    Returns the status line and headers, and any body bytes received along with them
+    """
+    data = bytearray(received)
+
+    while b"\r\n\r\n" not in data:
+        if len(data) > max_head_size:
+            raise ValueError("Upstream response headers are too large")
+
+        chunk = sock.recv(recv_size)
+        if not chunk:
+            raise ConnectionError("Upstream closed the connection before responding")
+        data += chunk
+
+    head, _, buffered = bytes(data).partition(b"\r\n\r\n")
+    return str(head, "ascii"), buffered
+
+
+class Upstream:
+    """
+    A backend server, with a pool of idle persistent connections to it
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        max_idle: int = 16,
+        connect_timeout: float = 2,
+        read_timeout: float = 30,
+    ) -> None:
+        self.address = (host, port)
+        self.max_idle = max_idle
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+        self.idle = deque()
+        self.lock = threading.Lock()
+
+        # Requests in flight, for least-connections balancing
+        self.active = 0
+        self.connections_opened = 0
+
+        # Passive health, consecutive failures eject the upstream for a while
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def __repr__(self) -> str:
+        return f"Upstream({self.address[0]}:{self.address[1]})"
+
+    def is_available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def acquire(self) -> tuple:
+        """
+        Get a pooled connection, or open a new one
+        Returns the connection and whether it was reused from the pool
+        """
+        with self.lock:
+            self.active += 1
+
+        while True:
+            with self.lock:
+                sock = self.idle.pop() if self.idle else None
+            if not sock:
+                break
+
+            if not self.is_dropped(sock):
+                return sock, True
+            sock.close()
+
+        try:
+            return self.connect(), False
+        except OSError:
+            with self.lock:
+                self.active -= 1
+            raise
+
+    @staticmethod
+    def is_dropped(sock: socket.socket) -> bool:
+        """
+        Check if an idle connection was closed by the upstream
+        NOTE: An idle connection has nothing to read, unless it was closed
+        """
+        timeout = sock.gettimeout()
+        sock.setblocking(False)
+        try:
+            sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            return False
+        except OSError:
+            pass
+        finally:
+            sock.settimeout(timeout)
+        return True
+
+    def connect(self) -> socket.socket:
+        sock = socket.create_connection(self.address, timeout=self.connect_timeout)
+        sock.settimeout(self.read_timeout)
+        with self.lock:
+            self.connections_opened += 1
+        return sock
+
+    def release(self, sock: socket.socket, reusable: bool) -> None:
+        """
+        Return a connection to the pool, or close it if it can't carry another request
+        """
+        with self.lock:
+            self.active -= 1
+            if reusable and len(self.idle) < self.max_idle:
+                self.idle.append(sock)
+                return
+
+        sock.close()
+
+    def record_success(self) -> None:
+        self.failures = 0
+
+    def record_failure(self, max_failures: int, eject_for: float) -> None:
+        self.failures += 1
+        if self.failures >= max_failures:
+            self.eject(eject_for)
+
+    def eject(self, eject_for: float) -> None:
+        self.failures = 0
+        self.ejected_until = time.monotonic() + eject_for
+        self.close()
+
+    def restore(self) -> None:
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def close(self) -> None:
+        """
+        Close idle pooled connections
+        """
+        with self.lock:
+            idle, self.idle = self.idle, deque()
+
+        for sock in idle:
+            sock.close()
+
+
+class UpstreamStatus:
+    """
+    A status code or phrase passed through from an upstream
+    NOTE: Stands in for StatusCode/StatusPhrase, which only list this server's statuses
+    """
+
+    def __init__(self, value) -> None:
+        self.value = value
+
+    def __repr__(self) -> str:
+        return f"UpstreamStatus({self.value!r})"
+
+
+class UpstreamResponse(response.Response):
+    """
+    An upstream response, its status and end-to-end headers passed through as they are
+    NOTE: Framing headers (Content-Length, Connection) are set by this server
+    """
+
+    def __init__(self, code: int, phrase: str, headers: list) -> None:
+        super().__init__()
+        self.status_code = UpstreamStatus(code)
+        self.status_phrase = UpstreamStatus(phrase)
+        self.headers = headers
+        self.content_length = self.get_header("Content-Length")
+
+    @staticmethod
+    def deserializer(res) -> "UpstreamResponse":
+        status_line, *lines = res.split("\r\n")
+        version, code, *phrase = status_line.split(None, 2)
+        if not version.startswith("HTTP/"):
+            raise ValueError(f"Malformed status line: {status_line}")
+
+        return UpstreamResponse(
+            int(code), phrase[0] if phrase else "", HTTPMessage.parse_headers(lines)
+        )
+
+    def serializer(self) -> str:
+        response_str = (
+            f"{self.version} {self.status_code.value} {self.status_phrase.value}\r\n"
+        )
+
+        for name, value in endToEndHeaders(self.headers, exclude=("content-length",)):
+            response_str += f"{name}: {value}\r\n"
+
+        if self.content_length:
+            response_str += f"Content-Length: {self.content_length}\r\n"
+        if self.connection:
+            response_str += f"Connection: {self.connection}\r\n"
+
+        return response_str + "\r\n"
+
+
+class UpstreamBody:
+    """
+    Streams an upstream response body, then returns the connection to its pool
+    Chunked bodies are decoded, so the client gets the body without its framing
+    NOTE: The server closes the body once sent, even if the client left mid-stream
+    """
+
+    # Longest chunk size or trailer line accepted
+    max_line_size = 8 * 1024
+
+    def __init__(
+        self,
+        upstream: Upstream,
+        sock: socket.socket,
+        buffered: bytes,
+        length: int,
+        reusable: bool,
+        chunk_size: int,
+        chunked: bool = False,
+    ) -> None:
+        self.upstream = upstream
+        self.sock = sock
+        self.buffered = buffered
+        self.length = length
+        self.chunked = chunked
+        self.reusable = reusable and (length is not None or chunked)
+        self.chunk_size = chunk_size
+        self.complete = False
+
+    def __iter__(self):
+        if self.chunked:
+            try:
+                yield from self.decode_chunks()
+            except ValueError as e:
+                # The headers were sent already, all that's left is to drop the client
+                raise ConnectionError(f"Malformed chunked body from upstream: {e}")
+            return
+
+        # Without a length, the body ends when the upstream closes the connection
+        remaining = self.length if self.length is not None else float("inf")
+        if len(self.buffered) > remaining:
+            # The upstream sent more than it said, so what follows can't be trusted
+            self.reusable = False
+
+        if self.buffered:
+            chunk = self.buffered[: int(min(remaining, len(self.buffered)))]
+            self.buffered = b""
+            remaining -= len(chunk)
+            yield chunk
+
+        while remaining > 0:
+            chunk = self.sock.recv(int(min(remaining, self.chunk_size)))
+            if not chunk:
+                if self.length is not None:
+                    raise ConnectionError("Upstream closed the connection mid-body")
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+        self.complete = True
+
+    def receive(self, buffer: bytearray) -> None:
+        chunk = self.sock.recv(self.chunk_size)
+        if not chunk:
+            raise ConnectionError("Upstream closed the connection mid-body")
+        buffer += chunk
+
+    def read_line(self, buffer: bytearray) -> bytes:
+        while b"\r\n" not in buffer:
+            if len(buffer) > self.max_line_size:
+                raise ValueError("Upstream chunk line is too long")
+            self.receive(buffer)
+
+        line, _, _ = buffer.partition(b"\r\n")
+        del buffer[: len(line) + 2]
+        return bytes(line)
+
+    def decode_chunks(self):
+        """
+        Yield the data of each chunk, until the last chunk and any trailers
+        """
+        buffer = bytearray(self.buffered)
+        self.buffered = b""
+
+        while True:
+            # Chunk extensions after ";" are ignored
+            size = int(self.read_line(buffer).split(b";", 1)[0].strip(), 16)
+            if not size:
+                break
+
+            remaining = size
+            while remaining > 0:
+                if not buffer:
+                    # Large chunks are passed on as they arrive, not buffered whole
+                    chunk = self.sock.recv(min(remaining, self.chunk_size))
+                    if not chunk:
+                        raise ConnectionError("Upstream closed the connection mid-body")
+                else:
+                    chunk = bytes(buffer[:remaining])
+                    del buffer[: len(chunk)]
+
+                remaining -= len(chunk)
+                yield chunk
+
+            if self.read_line(buffer):
+                raise ValueError("Upstream chunk is longer than its size")
+
+        # Trailers end with an empty line, they can't be sent once the headers were
+        while self.read_line(buffer):
+            pass
+
+        if buffer:
+            self.reusable = False
+        self.complete = True
+
+    def close(self) -> None:
+        if not self.sock:
+            return
+
+        self.upstream.release(self.sock, self.reusable and self.complete)
+        self.sock = None
+
+
+class ReverseProxy:
+    """
+    Forwards requests under a route prefix to a set of upstream servers
+    Connections to upstreams are pooled and reused, and upstreams that keep failing,
+    or fail active health checks, are ejected from balancing for a while
+    """
+
+    strategies = ("round_robin", "least_connections")
+
+    # Failures worth retrying on another connection
+    retryable_errors = (ConnectionRefusedError, ConnectionResetError, BrokenPipeError)
+
+    # Methods safe to send again, even if the upstream may have received them already
+    idempotent_methods = (
+        methods.Methods.HTTP_GET,
+        methods.Methods.HTTP_HEAD,
+        methods.Methods.HTTP_PUT,
+        methods.Methods.HTTP_DELETE,
+    )
+
+    def __init__(
+        self,
+        prefix: str,
+        upstreams: list,
+        strategy: str = "round_robin",
+        strip_prefix: bool = True,
+        max_failures: int = 3,
+        eject_for: float = 10,
+        health_check_interval: float = 5,
+        health_check_path: str = "/",
+        chunk_size: int = 64 * 1024,
+        max_head_size: int = 64 * 1024,
+    ) -> None:
+        if strategy not in self.strategies:
+            raise ValueError(f"Unknown balancing strategy: {strategy}")
+
+        self.prefix = prefix.lstrip("/")
+        self.upstreams = upstreams
+        self.strategy = strategy
+        self.strip_prefix = strip_prefix
+        self.max_failures = max_failures
+        self.eject_for = eject_for
+        self.health_check_interval = health_check_interval
+        self.health_check_path = health_check_path
+        self.chunk_size = chunk_size
+        self.max_head_size = max_head_size
+
+        self.counter = itertools.count()
+        self.stopped = threading.Event()
+        self.health_checker = None
+
+    @staticmethod
+    def from_spec(spec: str, **kwargs) -> "ReverseProxy":
+        """
+        Create a proxy from a PREFIX=HOST:PORT[,HOST:PORT...] specification
+        """
+        prefix, _, addresses = spec.partition("=")
+        upstreams = []
+        for address in addresses.split(","):
+            host, _, port = address.strip().rpartition(":")
+            upstreams.append(Upstream(host, int(port)))
+
+        return ReverseProxy(prefix, upstreams, **kwargs)
+
+    def matches(self, context: str) -> bool:
+        context = context.lstrip("/")
+        return (
+            not self.prefix
+            or context == self.prefix.rstrip("/")
+            or context.startswith(self.prefix)
+        )
+
+    def choose(self) -> Upstream:
+        """
+        Pick an upstream that isn't ejected, or None if there are none
+        """
+        now = time.monotonic()
+        candidates = [u for u in self.upstreams if u.is_available(now)]
+        if not candidates:
+            return None
+
+        if self.strategy == "least_connections":
+            return min(candidates, key=lambda u: u.active)
+        return candidates[next(self.counter) % len(candidates)]
+
+    def handle(self, request: request.Request) -> response.Response:
+        # Try another connection once, if the first failed before anything was processed
+        for attempt in range(2):
+            upstream = self.choose()
+            if not upstream:
+                return response.Response(
+                    status_code=status.StatusCode.HTTP_503_SERVICE_UNAVAILABLE,
+                    status_phrase=status.StatusPhrase.HTTP_503_SERVICE_UNAVAILABLE,
+                )
+
+            try:
+                return self.forward(upstream, request)
+            except TimeoutError:
+                upstream.record_failure(self.max_failures, self.eject_for)
+                return response.Response(
+                    status_code=status.StatusCode.HTTP_504_GATEWAY_TIMEOUT,
+                    status_phrase=status.StatusPhrase.HTTP_504_GATEWAY_TIMEOUT,
+                )
+            except self.retryable_errors as e:
+                upstream.record_failure(self.max_failures, self.eject_for)
+
+                # Unless refused, the upstream may have received the request already
+                retryable = isinstance(e, ConnectionRefusedError) or (
+                    request.method in self.idempotent_methods
+                )
+                if attempt or not retryable or not self.rewind_body(request):
+                    break
+            except (OSError, ValueError):
+                upstream.record_failure(self.max_failures, self.eject_for)
+                break
+
+        return response.Response(
+            status_code=status.StatusCode.HTTP_502_BAD_GATEWAY,
+            status_phrase=status.StatusPhrase.HTTP_502_BAD_GATEWAY,
+        )
+
+    @staticmethod
+    def rewind_body(request: request.Request) -> bool:
+        if not request.body_stream:
+            return True
+
+        try:
+            request.body_stream.seek(0)
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def upstream_request(self, request: request.Request) -> str:
+        """
+        Serialize the start line and headers of the request to send upstream
+        """
+        context = request.context.lstrip("/")
+        if self.strip_prefix and self.prefix:
+            context = context[len(self.prefix) :]
+        method = getattr(request.method, "value", request.method)
+
+        headers = request.headers
+        if headers is None:
+            # Built rather than received, so only its attributes are headers
+            head = str(request).split("\r\n\r\n", 1)[0]
+            headers = HTTPMessage.parse_headers(head.split("\r\n")[1:])
+
+        # 100-continue was already answered, and the upstream connection is pooled
+        request_str = f"{method} /{context.lstrip('/')} {request.version}\r\n"
+        for name, value in endToEndHeaders(headers, exclude=("expect",)):
+            request_str += f"{name}: {value}\r\n"
+        request_str += "Connection: keep-alive\r\n\r\n"
+
+        return request_str
+
+    def send_request(self, sock: socket.socket, request: request.Request) -> None:
+        sock.sendall(bytes(self.upstream_request(request), "ascii"))
+
+        if request.body_stream:
+            while chunk := request.body_stream.read(self.chunk_size):
+                sock.sendall(chunk)
+        elif request.body:
+            sock.sendall(bytes(request.body, "ascii"))
+
+    def forward(
+        self, upstream: Upstream, request: request.Request
+    ) -> response.Response:
+        sock, reused = upstream.acquire()
+
+        sent = False
+        try:
+            try:
+                self.send_request(sock, request)
+                sent = True
+                head, buffered = receiveHead(sock, self.chunk_size, self.max_head_size)
+            except self.retryable_errors + (ConnectionError,):
+                # A pooled connection may have been closed by the upstream while idle,
+                # once the request was sent it's only sent again if idempotent
+                if (
+                    not reused
+                    or (sent and request.method not in self.idempotent_methods)
+                    or not self.rewind_body(request)
+                ):
+                    raise
+
+                sock.close()
+                sock = upstream.connect()
+                self.send_request(sock, request)
+                head, buffered = receiveHead(sock, self.chunk_size, self.max_head_size)
+
+            res = UpstreamResponse.deserializer(head)
+
+            # Interim responses, e.g. 103 Early Hints, come before the final one
+            while res.status_code.value < 200:
+                head, buffered = receiveHead(
+                    sock, self.chunk_size, self.max_head_size, buffered
+                )
+                res = UpstreamResponse.deserializer(head)
+
+            has_no_body = request.method == methods.Methods.HTTP_HEAD or (
+                res.status_code.value
+                in (
+                    status.StatusCode.HTTP_204_NO_CONTENT.value,
+                    status.StatusCode.HTTP_304_NOT_MODIFIED.value,
+                )
+            )
+            # Chunked must be the last transfer coding, and overrides Content-Length
+            codings = res.get_header("Transfer-Encoding").lower().split(",")
+            chunked = not has_no_body and codings[-1].strip() == "chunked"
+            if chunked:
+                res.content_length = ""
+
+            length = 0 if has_no_body else None
+            if not has_no_body and not chunked and res.content_length:
+                length = int(res.content_length)
+        except Exception:
+            upstream.release(sock, False)
+            raise
+
+        upstream.record_success()
+
+        # Whether the connection persists is between this server and its client
+        reusable = "close" not in res.get_header("Connection").lower()
+
+        if length == 0:
+            upstream.release(sock, reusable)
+            return res
+
+        res.body_stream = UpstreamBody(
+            upstream, sock, buffered, length, reusable, self.chunk_size, chunked
+        )
+        return res
+
+    def check_health(self, upstream: Upstream) -> bool:
+        """
+        Make a HEAD request on a fresh connection, any response below 500 is healthy
+        """
+        health_check = request.Request(
+            method=methods.Methods.HTTP_HEAD,
+            context=self.health_check_path,
+            Connection="close",
+        )
+
+        try:
+            with socket.create_connection(
+                upstream.address, timeout=upstream.connect_timeout
+            ) as sock:
+                sock.settimeout(upstream.read_timeout)
+                sock.sendall(bytes(str(health_check), "ascii"))
+                head, _ = receiveHead(sock, self.chunk_size, self.max_head_size)
+                return int(head.split(None, 2)[1]) < 500
+        except (OSError, ValueError, IndexError):
+            return False
+
+    def check_all_health(self) -> None:
+        for upstream in self.upstreams:
+            if self.check_health(upstream):
+                upstream.restore()
+            elif upstream.is_available(time.monotonic()):
+                upstream.eject(self.eject_for)
+
+    def start(self) -> None:
+        """
+        Start active health checks in the background
+        """
+        if self.health_checker or not self.health_check_interval:
+            return
+
+        def run():
+            while not self.stopped.wait(self.health_check_interval):
+                self.check_all_health()
+
+        self.stopped.clear()
+        self.health_checker = threading.Thread(target=run, daemon=True)
+        self.health_checker.start()
+
+    def close(self) -> None:
+        self.stopped.set()
+        if self.health_checker:
+            self.health_checker.join()
+            self.health_checker = None
+
+        for upstream in self.upstreams:
+            upstream.close()
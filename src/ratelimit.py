@@ -0,0 +1,65 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+class TokenBucketLimiter:
+    """
+    Per-client token buckets, refilled lazily when a client is next seen
+    NOTE: Buckets are kept in least recently seen order, so the clients evicted
+    past max_clients are the idle ones, whose buckets would be full again anyway
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: float = None,
+        max_clients: int = 100_000,
+        clock=time.monotonic,
+    ) -> None:
+        if rate <= 0:
+            raise ValueError(f"Rate must be positive: {rate}")
+
+        self.rate = rate
+        # A bucket must hold at least one token, or slow rates would reject everything
+        self.burst = max(1.0, burst or rate)
+        self.max_clients = max_clients
+        self.clock = clock
+
+        # Client key -> (tokens, last refill time)
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def acquire(self, key) -> float:
+        """
+        Take a token from the client's bucket
+        Returns 0 if the request is allowed, otherwise the seconds until it would be
+        """
+        now = self.clock()
+
+        with self.lock:
+            bucket = self.buckets.get(key)
+
+            if bucket is None:
+                tokens = self.burst
+                if len(self.buckets) >= self.max_clients:
+                    self.buckets.popitem(last=False)
+            else:
+                tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                self.buckets.move_to_end(key)
+
+            if tokens >= 1:
+                self.buckets[key] = (tokens - 1, now)
+                return 0.0
+
+            self.buckets[key] = (tokens, now)
+
+        return (1 - tokens) / self.rate
+
+    @staticmethod
+    def retry_after(wait: float) -> str:
+        """
+        Format a wait as a Retry-After value in whole seconds
+        """
+        return str(max(1, math.ceil(wait)))
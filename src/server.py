@@ -1,40 +1,466 @@
+import argparse
+import signal
+import ssl
+import time
+from time import perf_counter_ns
 from socketserver import BaseRequestHandler, ThreadingTCPServer
+from tempfile import SpooledTemporaryFile
+from typing import Optional
 
 from classes.request import Request
 from classes.response import Response
 from enums.status import StatusCode, StatusPhrase
-from enums.methods import allowed_methods
-from crud import handleCRUDByMethod
+from enums.methods import Methods, allowed_methods
+from admin import handleAdmin, isLoopback
+from capture import TrafficCapture
+from crud import handleCRUDByMethod, validateCRUDByMethod
+from memory import MemoryDiagnostics
+from proxy import ReverseProxy
+from ratelimit import TokenBucketLimiter
+from tls import TLSConfig
+from tracing import NULL_SPAN, Tracer
+from vhosts import VirtualHostRouter
 
 
 class ServerDetails:
     host = "localhost"
     port = 9999
 
+    # TLS is enabled when a certificate is given
+    certfile = None
+    keyfile = None
+
+    # Seconds a client may take to complete the TLS handshake
+    handshake_timeout = 10
+
+    # Seconds to wait on a client while receiving a request
+    timeout = 30
+
+    # Seconds to wait for the next request on a persistent connection
+    keep_alive_timeout = 5
+    keep_alive_max_requests = 100
+    recv_size = 64 * 1024
+    max_head_size = 64 * 1024
+
+    # Request bodies larger than the threshold are spooled to a temporary file
+    body_spool_threshold = 1024 * 1024
+    max_body_size = 1024 * 1024 * 1024
+
+    # Requests per second allowed per client, rate limiting is off when unset
+    rate_limit = None
+    rate_limit_burst = None
+    rate_limit_max_clients = 100_000
+
+    # Header naming the client instead of its address, e.g. X-Forwarded-For or X-Real-IP
+    rate_limit_header = None
+
+    # Traced requests are kept if sampled, or if slower than the threshold
+    trace_sample_rate = 0.01
+    trace_slow_threshold_ms = 500
+    trace_buffer_size = 1024
+
+    # Share of requests whose allocations are accounted when memory diagnostics are on
+    memory_sample_rate = 0.01
+
+    # Diagnostics are served under this path when the admin endpoints are enabled
+    admin_prefix = "_admin/"
+
+    # Admin endpoints are only served to clients on this machine, unless allowed
+    admin_allow_remote = False
+
 
 class ThreadedTCPRequestHandler(BaseRequestHandler):
     def handle(self):
-        data = str(self.request.recv(1024).strip(), "ascii")
+        # Bytes received past the end of the previous request, e.g. when pipelining
+        self.pending = b""
+        self.requests_served = 0
 
-        if not data:
-            res = Response(
-                status_code=StatusCode.HTTP_400_BAD_REQUEST,
-                status_phrase=StatusPhrase.HTTP_400_BAD_REQUEST,
+        # The first request's span started when the connection was accepted
+        self.span = self.server.spans.pop(self.request, NULL_SPAN)
+        self.span.mark_started()
+
+        # Serve requests until either side wants the connection closed
+        while True:
+            self.keep_alive = False
+            self.deserialized_request = None
+            self.serveRequest()
+            self.requests_served += 1
+
+            # Idle time isn't part of a request, so the next span starts with its bytes
+            if not self.keep_alive or not self.waitForRequest():
+                break
+
+            tracer = self.server.tracer
+            self.span = tracer.start_span() if tracer else NULL_SPAN
+            self.span.bytes_in += len(self.pending)
+
+    def waitForRequest(self) -> bool:
+        """
+        Wait for the next request on a persistent connection
+        Returns False if the client closed the connection, or stayed idle too long
+        """
+        if self.pending:
+            # Pipelined behind the previous request
+            return True
+
+        # Idle persistent connections are closed sooner than slow requests
+        self.request.settimeout(ServerDetails.keep_alive_timeout)
+        try:
+            self.pending = self.request.recv(ServerDetails.recv_size)
+        except OSError:
+            return False
+
+        return bool(self.pending)
+
+    def serveRequest(self):
+        # Set once the request is received, if its memory use is sampled
+        self.memory_started_with = None
+
+        try:
+            self.handleRequest()
+        finally:
+            if self.span is not NULL_SPAN:
+                self.server.tracer.finish(self.span)
+
+            if self.memory_started_with is not None:
+                self.server.memory.end_request(
+                    self.deserialized_request.context, self.memory_started_with
+                )
+
+    def handleRequest(self):
+        self.request.settimeout(ServerDetails.timeout)
+
+        try:
+            head, buffered, head_ended = self.receiveHead()
+        except OSError:
+            return
+
+        arrived_ns = time.monotonic_ns()
+
+        if not head:
+            # The client sent nothing at all, or a head that was too large or cut short
+            self.sendBadRequest()
+            return
+
+        try:
+            with self.span.phase("deserialize"):
+                self.deserialized_request = Request.deserializer(head)
+            content_length = self.receiveContentLength()
+        except Exception:
+            self.sendBadRequest()
+            return
+
+        if self.server.memory:
+            self.memory_started_with = self.server.memory.begin_request()
+
+        # Requests for hosts this server doesn't serve are rejected
+        if self.server.vhosts:
+            self.deserialized_request.vhost = self.server.vhosts.lookup(
+                self.deserialized_request.get_header("Host")
             )
-            self.request.sendall(bytes(str(res), "ascii"))
+            if not self.deserialized_request.vhost:
+                self.sendBadRequest()
+                return
+
+        method = self.deserialized_request.method
+        self.span.method = getattr(method, "value", method)
+        self.span.route = self.deserialized_request.context
+
+        self.proxy = next(
+            (
+                proxy
+                for proxy in self.server.proxies
+                if proxy.matches(self.deserialized_request.context)
+            ),
+            None,
+        )
+
+        rejection = self.checkRateLimit() or self.checkRequestBody(content_length)
+        if rejection:
+            self.sendResponse(rejection)
+            self.captureRequest(arrived_ns, head, None, content_length, rejection)
+            return
+
+        try:
+            body_stream = self.receiveBody(buffered, content_length)
+        except OSError:
             return
 
-        self.deserialized_request = Request.deserializer(data)
-        self.fulfillRequest()
+        # The whole request has been received, so the connection can be reused, unless
+        # the head was cut short and where the next request starts isn't known
+        self.keep_alive = head_ended and self.wantsKeepAlive()
 
+        with body_stream:
+            self.deserialized_request.body_stream = body_stream
+            with self.span.phase("handler"):
+                self.fulfillRequest()
+
+            # A body sent without a length would be read as the next request
+            if (
+                self.serialized_response.status_code.value
+                == StatusCode.HTTP_411_LENGTH_REQUIRED.value
+            ):
+                self.keep_alive = False
+            self.sendResponse(self.serialized_response)
+            self.captureRequest(
+                arrived_ns, head, body_stream, content_length, self.serialized_response
+            )
+
+    def receiveHead(self) -> tuple:
+        """
+        Receive until the empty line that ends the headers
+        Returns the start line and headers, any body bytes received along with them,
+        and whether the empty line was received
+        """
+        data = bytearray(self.pending)
+        self.pending = b""
+
+        while b"\r\n\r\n" not in data:
+            if len(data) > ServerDetails.max_head_size:
+                return "", b"", False
+
+            try:
+                start = perf_counter_ns()
+                chunk = self.request.recv(ServerDetails.recv_size)
+                self.span.record_recv(start, len(chunk))
+            except TimeoutError:
+                # Serve what was sent, some clients omit the empty line without a body
+                break
+
+            if not chunk:
+                break
+            data += chunk
+
+        head, separator, buffered = bytes(data).partition(b"\r\n\r\n")
         try:
-            self.request.sendall(bytes(str(self.serialized_response), "ascii"))
+            return str(head.strip(), "ascii"), buffered, bool(separator)
+        except UnicodeDecodeError:
+            return "", b"", False
+
+    def receiveContentLength(self) -> int:
+        """
+        Get the length of the request body from the Content-Length header
+        Raises ValueError if the header is malformed or given more than once
+        """
+        request = self.deserialized_request
+        lengths = [v for k, v in request.headers if k.lower() == "content-length"]
+        if not lengths:
+            return 0
+
+        # Anything but one length could be read differently by a proxy in front of us
+        if len(lengths) > 1 or not lengths[0].isdigit():
+            raise ValueError(f"Invalid Content-Length: {', '.join(lengths)}")
+
+        # Handlers check the attribute, whatever case the header was sent in
+        request.content_length = lengths[0]
+        return int(lengths[0])
+
+    def checkRateLimit(self) -> Optional[Response]:
+        """
+        Reject the request if the client has run out of tokens
+        """
+        limiter = self.server.rate_limiter
+        if not limiter:
+            return None
+
+        key = self.client_address[0]
+        if ServerDetails.rate_limit_header:
+            value = self.deserialized_request.get_header(
+                ServerDetails.rate_limit_header
+            )
+            # X-Forwarded-For lists the client first, then each proxy in between
+            key = value.split(",", 1)[0].strip() or key
+
+        wait = limiter.acquire(key)
+        if not wait:
+            return None
+
+        return Response(
+            status_code=StatusCode.HTTP_429_TOO_MANY_REQUESTS,
+            status_phrase=StatusPhrase.HTTP_429_TOO_MANY_REQUESTS,
+            **{"Retry-After": limiter.retry_after(wait)},
+        )
+
+    def checkRequestBody(self, content_length: int) -> Optional[Response]:
+        """
+        Reject the request before its body is received, if possible
+        Clients sending Expect: 100-continue wait for this before sending the body
+        """
+        # Chunked bodies aren't decoded, so the end of the body can't be found
+        if self.deserialized_request.get_header("Transfer-Encoding"):
+            return Response(
+                status_code=StatusCode.HTTP_411_LENGTH_REQUIRED,
+                status_phrase=StatusPhrase.HTTP_411_LENGTH_REQUIRED,
+            )
+
+        if content_length > ServerDetails.max_body_size:
+            return Response(
+                status_code=StatusCode.HTTP_413_PAYLOAD_TOO_LARGE,
+                status_phrase=StatusPhrase.HTTP_413_PAYLOAD_TOO_LARGE,
+            )
+
+        if self.deserialized_request.get_header("Expect").lower() != "100-continue":
+            return None
+
+        # Proxied requests are validated by the upstream server
+        if self.deserialized_request.method in allowed_methods and not self.proxy:
+            rejection = validateCRUDByMethod(self.deserialized_request)
+            if rejection:
+                return rejection
+
+        self.request.sendall(
+            bytes(
+                f"{self.deserialized_request.version} "
+                f"{StatusCode.HTTP_100_CONTINUE.value} "
+                f"{StatusPhrase.HTTP_100_CONTINUE.value}\r\n\r\n",
+                "ascii",
+            )
+        )
+        return None
+
+    def receiveBody(self, buffered: bytes, content_length: int) -> SpooledTemporaryFile:
+        """
+        Receive the request body into a file-like object
+        Small bodies stay in memory, larger ones are spooled to a temporary file
+        """
+        body_stream = SpooledTemporaryFile(max_size=ServerDetails.body_spool_threshold)
+
+        try:
+            body_stream.write(buffered[:content_length])
+            remaining = content_length - min(len(buffered), content_length)
+            self.pending = buffered[content_length:]
+
+            # Reuse one buffer so memory stays flat regardless of the body size
+            buffer = memoryview(bytearray(ServerDetails.recv_size))
+            while remaining > 0:
+                start = perf_counter_ns()
+                received = self.request.recv_into(buffer[: min(remaining, len(buffer))])
+                self.span.record_recv(start, received)
+                if not received:
+                    raise ConnectionError("Connection closed while receiving the body")
+                body_stream.write(buffer[:received])
+                remaining -= received
+
+            body_stream.seek(0)
         except Exception:
-            res = Response(
-                status_code=StatusCode.HTTP_400_BAD_REQUEST,
-                status_phrase=StatusPhrase.HTTP_400_BAD_REQUEST,
+            body_stream.close()
+            raise
+
+        return body_stream
+
+    def captureRequest(
+        self, arrived_ns: int, head: str, body_stream, content_length: int, res
+    ):
+        if not self.server.capture:
+            return
+
+        self.server.capture.record(
+            arrived_ns,
+            self.client_address,
+            head,
+            body_stream,
+            content_length,
+            res.status_code.value,
+        )
+
+    def wantsKeepAlive(self) -> bool:
+        """
+        Check if the client wants to send more requests on this connection
+        HTTP/1.1 connections persist unless closed, HTTP/1.0 ones only if asked to
+        """
+        if self.requests_served + 1 >= ServerDetails.keep_alive_max_requests:
+            return False
+
+        # Connection is a list, e.g. "close, X-Custom" names a hop-by-hop header too
+        header = self.deserialized_request.get_header("Connection")
+        connection = [token.strip() for token in header.lower().split(",")]
+        if self.deserialized_request.version == "HTTP/1.1":
+            return "close" not in connection
+        return "keep-alive" in connection
+
+    def hasNoBody(self, res: Response) -> bool:
+        """
+        Check if the response ends with its headers, whatever body its handler set
+        """
+        request = self.deserialized_request
+
+        # Proxied statuses aren't StatusCode members, so compare values
+        return (request is not None and request.method == Methods.HTTP_HEAD) or (
+            res.status_code.value
+            in (
+                StatusCode.HTTP_204_NO_CONTENT.value,
+                StatusCode.HTTP_304_NOT_MODIFIED.value,
             )
-            self.request.sendall(bytes(str(res), "ascii"))
+        )
+
+    def frameResponse(self, res: Response):
+        """
+        Make sure the client can find the end of the response without the connection
+        closing
+        Otherwise, the connection is closed after the response
+        """
+        if self.hasNoBody(res):
+            # A body here would be read as the start of the next response
+            if res.body_stream and hasattr(res.body_stream, "close"):
+                res.body_stream.close()
+            res.body = None
+            res.body_stream = None
+        elif not res.content_length:
+            if res.body_stream:
+                # Streamed without a known length, the end is when the connection closes
+                self.keep_alive = False
+            else:
+                res.content_length = str(len(res.body or ""))
+
+        if not self.keep_alive:
+            res.connection = "close"
+
+    def sendResponse(self, res: Response):
+        self.span.status = res.status_code.value
+
+        try:
+            self.frameResponse(res)
+
+            try:
+                with self.span.phase("serialize"):
+                    payload = bytes(str(res), "ascii")
+            except Exception:
+                self.keep_alive = False
+                self.sendBadRequest()
+                return
+
+            try:
+                with self.span.phase("sendall"):
+                    # Streamed bodies follow the headers chunk by chunk, the first
+                    # one is sent along with them so small bodies take a single send
+                    chunks = iter(res.body_stream or ())
+                    first = next(chunks, b"")
+                    self.request.sendall(payload + first)
+                    self.span.bytes_out = len(payload) + len(first)
+
+                    for chunk in chunks:
+                        self.request.sendall(chunk)
+                        self.span.bytes_out += len(chunk)
+            except OSError:
+                self.keep_alive = False
+        finally:
+            if res.body_stream and hasattr(res.body_stream, "close"):
+                res.body_stream.close()
+
+    def sendBadRequest(self):
+        res = Response(
+            status_code=StatusCode.HTTP_400_BAD_REQUEST,
+            status_phrase=StatusPhrase.HTTP_400_BAD_REQUEST,
+            Connection="close",
+        )
+        payload = bytes(str(res), "ascii")
+        self.span.status = res.status_code.value
+        self.span.bytes_out = len(payload)
+        try:
+            self.request.sendall(payload)
+        except OSError:
+            # The client is already gone
+            pass
 
     def fulfillRequest(self):
         # Only handle specified methods
@@ -49,6 +475,16 @@ class ThreadedTCPRequestHandler(BaseRequestHandler):
             return
 
         try:
+            if self.server.admin and self.deserialized_request.context.startswith(
+                ServerDetails.admin_prefix
+            ):
+                self.serialized_response = self.fulfillAdminRequest()
+                return
+
+            if self.proxy:
+                self.serialized_response = self.proxy.handle(self.deserialized_request)
+                return
+
             self.serialized_response = handleCRUDByMethod(self.deserialized_request)
         except Exception:
             self.serialized_response = Response(
@@ -57,19 +493,182 @@ class ThreadedTCPRequestHandler(BaseRequestHandler):
             )
         return
 
+    def fulfillAdminRequest(self) -> Response:
+        # Diagnostics reveal routes and traffic, so keep them to this machine
+        remote = not isLoopback(self.client_address[0])
+        if remote and not ServerDetails.admin_allow_remote:
+            return Response(
+                status_code=StatusCode.HTTP_403_FORBIDDEN,
+                status_phrase=StatusPhrase.HTTP_403_FORBIDDEN,
+            )
+
+        return handleAdmin(self.deserialized_request, self.server)
+
 
 class ThreadedTCPServer(ThreadingTCPServer):
-    def __init__(self, server_address, handler, meta=None, *args, **kwargs):
+    # Must be set before the socket is bound in __init__
+    allow_reuse_address = True
+
+    def __init__(
+        self,
+        server_address,
+        handler,
+        meta=None,
+        tls: TLSConfig = None,
+        rate_limiter: TokenBucketLimiter = None,
+        tracer: Tracer = None,
+        memory: MemoryDiagnostics = None,
+        vhosts: VirtualHostRouter = None,
+        proxies: list = None,
+        capture: TrafficCapture = None,
+        admin: bool = False,
+        *args,
+        **kwargs,
+    ):
         super().__init__(server_address, handler)
-        self.allow_reuse_address = True
         self.meta = meta
+        self.tls = tls
+        self.rate_limiter = rate_limiter
+        self.tracer = tracer
+        self.memory = memory
+        self.vhosts = vhosts
+        self.proxies = proxies or []
+        self.capture = capture
+        self.admin = admin
+
+        # Spans of accepted connections, until their handler picks them up
+        self.spans = {}
+        self.tls_checked_at = time.monotonic()
+
+        if self.tls:
+            self.socket = self.tls.wrap_listening_socket(self.socket)
+
+        for proxy in self.proxies:
+            proxy.start()
+
+    def server_close(self):
+        # Close pooled upstream connections first, their handlers are joined below
+        for proxy in self.proxies:
+            proxy.close()
+
+        super().server_close()
+
+        if self.capture:
+            self.capture.close()
+
+    def get_request(self):
+        request, client_address = super().get_request()
+        if self.tracer:
+            self.spans[request] = self.tracer.start_span()
+        return request, client_address
+
+    def finish_request(self, request, client_address):
+        # Runs in the worker thread, so a slow handshake doesn't block accept()
+        if self.tls:
+            try:
+                with self.spans.get(request, NULL_SPAN).phase("tls_handshake"):
+                    request.settimeout(ServerDetails.handshake_timeout)
+                    request.do_handshake()
+                    request.settimeout(None)
+            except (ssl.SSLError, OSError):
+                span = self.spans.pop(request, None)
+                if span:
+                    self.tracer.finish(span)
+                return
+
+        super().finish_request(request, client_address)
+
+    def service_actions(self):
+        # Called by serve_forever() between polls, pick up renewed certificates
+        if not self.tls:
+            return
+
+        now = time.monotonic()
+        if now - self.tls_checked_at >= self.tls.reload_interval:
+            self.tls_checked_at = now
+            self.tls.reload_certificate_if_changed()
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="A simple HTTP server")
+    parser.add_argument("--certfile", default=ServerDetails.certfile)
+    parser.add_argument("--keyfile", default=ServerDetails.keyfile)
+    parser.add_argument("--rate-limit", type=float, default=ServerDetails.rate_limit)
+    parser.add_argument(
+        "--rate-limit-burst", type=float, default=ServerDetails.rate_limit_burst
+    )
+    parser.add_argument("--trace", action="store_true", help="Trace requests")
+    parser.add_argument("--trace-file", help="Also write traces to a JSON-lines file")
+    parser.add_argument(
+        "--memory", action="store_true", help="Trace allocations with tracemalloc"
+    )
+    parser.add_argument(
+        "--vhosts", help="JSON file mapping Host patterns to document roots"
+    )
+    parser.add_argument(
+        "--proxy",
+        action="append",
+        default=[],
+        metavar="PREFIX=HOST:PORT[,HOST:PORT...]",
+        help="Forward requests under PREFIX to upstream servers",
+    )
+    parser.add_argument(
+        "--proxy-strategy",
+        choices=ReverseProxy.strategies,
+        default=ReverseProxy.strategies[0],
+    )
+    parser.add_argument(
+        "--capture", help="Record requests to a JSON-lines file for replaying"
+    )
+    parser.add_argument("--admin", action="store_true", help="Serve admin endpoints")
+    args = parser.parse_args()
+
+    tls = TLSConfig(args.certfile, args.keyfile) if args.certfile else None
+    rate_limiter = (
+        TokenBucketLimiter(
+            args.rate_limit,
+            args.rate_limit_burst,
+            ServerDetails.rate_limit_max_clients,
+        )
+        if args.rate_limit
+        else None
+    )
+    tracer = (
+        Tracer(
+            ServerDetails.trace_sample_rate,
+            ServerDetails.trace_slow_threshold_ms,
+            ServerDetails.trace_buffer_size,
+            args.trace_file,
+        )
+        if args.trace or args.trace_file
+        else None
+    )
+
+    memory = None
+    if args.memory:
+        memory = MemoryDiagnostics(ServerDetails.memory_sample_rate)
+        memory.start()
+
     with ThreadedTCPServer(
-        (ServerDetails.host, ServerDetails.port), ThreadedTCPRequestHandler
+        (ServerDetails.host, ServerDetails.port),
+        ThreadedTCPRequestHandler,
+        tls=tls,
+        rate_limiter=rate_limiter,
+        tracer=tracer,
+        memory=memory,
+        vhosts=VirtualHostRouter.from_file(args.vhosts) if args.vhosts else None,
+        proxies=[
+            ReverseProxy.from_spec(spec, strategy=args.proxy_strategy)
+            for spec in args.proxy
+        ],
+        capture=TrafficCapture(args.capture) if args.capture else None,
+        admin=args.admin,
     ) as server:
         host, port = server.server_address
 
-        print(f"Serving on {host}:{port}")
+        # Reload the certificate on demand, e.g. after renewal
+        if tls and hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, lambda *_: tls.try_reload_certificate())
+
+        print(f"Serving on {host}:{port}" + (" (TLS)" if tls else ""))
         server.serve_forever()
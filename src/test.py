@@ -1,12 +1,41 @@
+import base64
+import os
+import json
+import shutil
+import ssl
+import struct
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
-from unittest import TestCase, main
-from socket import socket, AF_INET, SOCK_STREAM, SHUT_RDWR
+from unittest import TestCase, main, skipUnless
+from socket import (
+    socket,
+    AF_INET,
+    SOCK_STREAM,
+    SHUT_RDWR,
+    SOL_SOCKET,
+    SO_LINGER,
+    create_connection,
+    create_server,
+)
 
 from classes.request import Request
 from classes.response import Response
 from enums.status import StatusCode, StatusPhrase
 from enums.methods import Methods
-from utils import DateUtilsBase, FileUtilsBase
+from utils import DateUtilsBase, FileBody, FileUtilsBase
+from server import ServerDetails, ThreadedTCPServer, ThreadedTCPRequestHandler
+from admin import isLoopback
+from tls import TLSConfig, create_self_signed_certificate
+from ratelimit import TokenBucketLimiter
+from tracing import Tracer
+from memory import MemoryDiagnostics
+from vhosts import VirtualHost, VirtualHostRouter
+from proxy import ReverseProxy, Upstream
+from capture import TrafficCapture, load_capture
+from benchmarks.replay import replay, summarize
 
 
 class TestServer(TestCase):
@@ -39,6 +68,12 @@ class TestServer(TestCase):
             return
         return str(self.sock.recv(1024), "ascii")
 
+    def receive_all(self):
+        data = b""
+        while chunk := self.sock.recv(1024):
+            data += chunk
+        return str(data, "ascii")
+
     ##########
     #  GET   #
     ##########
@@ -85,6 +120,52 @@ class TestServer(TestCase):
         self.assertEqual(response.status_phrase, StatusPhrase.HTTP_200_OK)
         self.assertEqual(response.body, expected_response_body)
 
+    def test_get_non_ascii_file_length_matches_head(self):
+        content = "caf\u00e9 \u2615".encode("utf-8")
+
+        with tempfile.NamedTemporaryFile(dir=".", suffix=".html") as f:
+            f.write(content)
+            f.flush()
+            context = os.path.basename(f.name)
+
+            self.send(str(Request(method=Methods.HTTP_HEAD, context=context)))
+            head = Response.deserializer(self.receive())
+
+            self.send(str(Request(context=context, Connection="close")))
+            data = b""
+            while chunk := self.sock.recv(1024):
+                data += chunk
+
+        self.assertEqual(head.content_length, str(len(content)))
+        self.assertIn(bytes(f"Content-Length: {len(content)}\r\n", "ascii"), data)
+        self.assertTrue(data.endswith(b"\r\n\r\n" + content))
+
+    def test_get_large_file_streamed(self):
+        content = os.urandom(1024 * 1024)
+
+        with tempfile.NamedTemporaryFile(dir=".", suffix=".html") as f:
+            f.write(content)
+            f.flush()
+
+            req = Request(context=os.path.basename(f.name), Connection="close")
+            self.send(str(req))
+            data = b""
+            while chunk := self.sock.recv(64 * 1024):
+                data += chunk
+
+        head, _, body = data.partition(b"\r\n\r\n")
+        self.assertIn(bytes(f"Content-Length: {len(content)}\r\n", "ascii"), head)
+        self.assertEqual(body, content)
+
+    def test_file_body_truncated(self):
+        with tempfile.TemporaryFile() as f:
+            f.write(b"x" * 10)
+            f.seek(0)
+
+            # Sent as far as it goes, then the client is dropped
+            with self.assertRaises(ConnectionError):
+                list(FileBody(f, 20, chunk_size=4))
+
     def test_get_authorized_and_file_exists_and_is_cached(self):
         # Should always be unmodified
         modified_timestamp = (
@@ -114,6 +195,7 @@ class TestServer(TestCase):
         self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
         self.assertEqual(response.status_phrase, StatusPhrase.HTTP_200_OK)
         self.assertEqual(response.body, "")
+        self.assertEqual(response.content_length, str(len("hello :)")))
 
     def test_head_unauthorized(self):
         req = Request(method=Methods.HTTP_HEAD, context="server.py")
@@ -137,12 +219,17 @@ class TestServer(TestCase):
         req = Request(method=Methods.HTTP_HEAD, context=self.test_file)
         self.send(str(req))
 
-        # TODO: Assert headers equal?
-
         response = Response.deserializer(self.receive())
         self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
         self.assertEqual(response.status_phrase, StatusPhrase.HTTP_200_OK)
         self.assertEqual(response.body, "")
+        self.assertEqual(
+            response.content_length, str(Path(self.test_file).stat().st_size)
+        )
+        self.assertEqual(
+            response.last_modified,
+            FileUtilsBase().get_file_last_modified_time_as_string(self.test_file),
+        )
 
     def test_head_authorized_and_file_exists_and_is_cached(self):
         # Should always be unmodified
@@ -192,6 +279,68 @@ class TestServer(TestCase):
         self.assertEqual(response.status_phrase, StatusPhrase.HTTP_411_LENGTH_REQUIRED)
         self.assertEqual(response.body, "")
 
+    def test_post_large_body(self):
+        content = "x" * (4 * 1024 * 1024)
+        content_length = len(content)
+
+        headers = {"Content-Type": "text/plain", "Content-Length": content_length}
+
+        req = Request(method=Methods.HTTP_POST, body=content, **headers)
+        self.send(str(req))
+
+        response = Response.deserializer(self.receive())
+        self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
+        self.assertEqual(response.status_phrase, StatusPhrase.HTTP_200_OK)
+
+    def test_post_too_large(self):
+        headers = {
+            "Content-Type": "text/plain",
+            "Content-Length": ServerDetails.max_body_size + 1,
+        }
+
+        req = Request(method=Methods.HTTP_POST, **headers)
+        self.send(str(req))
+
+        response = Response.deserializer(self.receive())
+        self.assertEqual(response.status_code, StatusCode.HTTP_413_PAYLOAD_TOO_LARGE)
+        self.assertEqual(
+            response.status_phrase, StatusPhrase.HTTP_413_PAYLOAD_TOO_LARGE
+        )
+
+    def test_post_expect_continue(self):
+        content = "Test data"
+        content_length = len(content)
+
+        headers = {
+            "Content-Type": "text/plain",
+            "Content-Length": content_length,
+            "Expect": "100-continue",
+        }
+
+        # Send the headers only, the body follows once the server agrees
+        req = Request(method=Methods.HTTP_POST, **headers)
+        self.send(str(req))
+
+        response = Response.deserializer(self.receive())
+        self.assertEqual(response.status_code, StatusCode.HTTP_100_CONTINUE)
+        self.assertEqual(response.status_phrase, StatusPhrase.HTTP_100_CONTINUE)
+
+        self.send(content)
+
+        response = Response.deserializer(self.receive())
+        self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
+        self.assertEqual(response.status_phrase, StatusPhrase.HTTP_200_OK)
+
+    def test_post_expect_continue_without_content_length(self):
+        headers = {"Content-Type": "text/plain", "Expect": "100-continue"}
+
+        req = Request(method=Methods.HTTP_POST, **headers)
+        self.send(str(req))
+
+        response = Response.deserializer(self.receive())
+        self.assertEqual(response.status_code, StatusCode.HTTP_411_LENGTH_REQUIRED)
+        self.assertEqual(response.status_phrase, StatusPhrase.HTTP_411_LENGTH_REQUIRED)
+
     ##########
     #  PUT   #
     ##########
@@ -265,6 +414,20 @@ class TestServer(TestCase):
         self.assertEqual(response.status_phrase, StatusPhrase.HTTP_404_NOT_FOUND)
         self.assertEqual(response.body, "")
 
+    def test_put_expect_continue_not_exists(self):
+        headers = {
+            "Content-Type": "text/plain",
+            "Content-Length": 17,
+            "Expect": "100-continue",
+        }
+
+        req = Request(method=Methods.HTTP_PUT, context="t.html", **headers)
+        self.send(str(req))
+
+        response = Response.deserializer(self.receive())
+        self.assertEqual(response.status_code, StatusCode.HTTP_404_NOT_FOUND)
+        self.assertEqual(response.status_phrase, StatusPhrase.HTTP_404_NOT_FOUND)
+
     ##########
     # DELETE #
     ##########
@@ -300,6 +463,68 @@ class TestServer(TestCase):
     #  Other #
     ##########
 
+    def test_keep_alive(self):
+        for _ in range(2):
+            self.send(str(Request()))
+
+            response = Response.deserializer(self.receive())
+            self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
+            self.assertEqual(response.body, "hello :)")
+
+    def test_connection_close_any_case(self):
+        self.send("GET / HTTP/1.1\r\nconnection: close\r\n\r\n")
+
+        # Returns once the server closes the connection, not at the idle timeout
+        start = time.monotonic()
+        response = Response.deserializer(self.receive_all())
+        self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
+        self.assertEqual(response.connection, "close")
+        self.assertLess(time.monotonic() - start, ServerDetails.keep_alive_timeout)
+
+    def test_content_length_any_case(self):
+        # Read as a second request if the length were missed
+        content = str(Request(method=Methods.HTTP_DELETE, context=self.test_file))
+        self.send(
+            "POST / HTTP/1.1\r\nContent-Type: text/plain\r\nConnection: close\r\n"
+            f"content-length: {len(content)}\r\n\r\n{content}"
+        )
+
+        data = self.receive_all()
+        self.assertEqual(data.count("HTTP/1.1 "), 1)
+        self.assertEqual(
+            Response.deserializer(data).status_code, StatusCode.HTTP_200_OK
+        )
+
+    def test_duplicate_content_length_rejected(self):
+        self.send(
+            "POST / HTTP/1.1\r\nContent-Type: text/plain\r\n"
+            "Content-Length: 5\r\nContent-Length: 6\r\n\r\nhello!"
+        )
+
+        data = self.receive_all()
+        self.assertEqual(data.count("HTTP/1.1 "), 1)
+        response = Response.deserializer(data)
+        self.assertEqual(response.status_code, StatusCode.HTTP_400_BAD_REQUEST)
+
+    def test_transfer_encoding_rejected(self):
+        self.send(
+            "POST / HTTP/1.1\r\nContent-Type: text/plain\r\n"
+            "Transfer-Encoding: chunked\r\n\r\n"
+            "26\r\nDELETE test.html HTTP/1.1\r\nHost: x\r\n\r\n\r\n0\r\n\r\n"
+        )
+
+        data = self.receive_all()
+        self.assertEqual(data.count("HTTP/1.1 "), 1)
+        response = Response.deserializer(data)
+        self.assertEqual(response.status_code, StatusCode.HTTP_411_LENGTH_REQUIRED)
+        self.assertEqual(response.connection, "close")
+
+    def test_non_ascii_head_rejected(self):
+        self.sock.sendall(b"GET /caf\xc3\xa9.html HTTP/1.1\r\n\r\n")
+
+        response = Response.deserializer(self.receive_all())
+        self.assertEqual(response.status_code, StatusCode.HTTP_400_BAD_REQUEST)
+
     def test_unsupported_method_not_ok(self):
         req = Request(method="UNSUPPORTED", context=self.test_file)
         self.send(str(req))
@@ -310,5 +535,950 @@ class TestServer(TestCase):
         self.assertEqual(response.body, "")
 
 
+@skipUnless(shutil.which("openssl"), "openssl is required to generate certificates")
+class TestTLS(TestCase):
+    """
+    Test TLS termination against an in-process server
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.directory = tempfile.TemporaryDirectory()
+        cls.certfile = os.path.join(cls.directory.name, "cert.pem")
+        cls.keyfile = os.path.join(cls.directory.name, "key.pem")
+        create_self_signed_certificate(cls.certfile, cls.keyfile)
+
+        cls.tls = TLSConfig(cls.certfile, cls.keyfile)
+        cls.server = ThreadedTCPServer(
+            ("localhost", 0), ThreadedTCPRequestHandler, tls=cls.tls
+        )
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.directory.cleanup()
+
+    def setUp(self):
+        self.context = ssl.create_default_context(cafile=self.certfile)
+        self.context.set_alpn_protocols(["h2", "http/1.1"])
+
+    def request(self, session=None):
+        """
+        Make a GET request, returns the response and the TLS connection details
+        """
+        sock = self.context.wrap_socket(
+            create_connection(self.server.server_address),
+            server_hostname="localhost",
+            session=session,
+        )
+        with sock:
+            sock.sendall(bytes(str(Request()), "ascii"))
+            response = Response.deserializer(str(sock.recv(1024), "ascii"))
+            details = {
+                "alpn": sock.selected_alpn_protocol(),
+                "session": sock.session,
+                "reused": sock.session_reused,
+            }
+        return response, details
+
+    def test_get_over_tls(self):
+        response, _ = self.request()
+        self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
+        self.assertEqual(response.body, "hello :)")
+
+    def test_alpn_selects_http_1_1(self):
+        _, details = self.request()
+        self.assertEqual(details["alpn"], "http/1.1")
+
+    def test_session_is_resumed(self):
+        _, first = self.request()
+        _, second = self.request(session=first["session"])
+        self.assertFalse(first["reused"])
+        self.assertTrue(second["reused"])
+
+    def test_reload_certificate_keeps_sessions(self):
+        _, first = self.request()
+        self.tls.reload_certificate()
+        response, second = self.request(session=first["session"])
+        self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
+        self.assertTrue(second["reused"])
+
+    def test_invalid_certificate_is_not_loaded(self):
+        with open(self.keyfile, "r") as f:
+            key = f.read()
+
+        try:
+            with open(self.keyfile, "w") as f:
+                f.write(key[: len(key) // 2])
+            self.assertFalse(self.tls.try_reload_certificate())
+        finally:
+            with open(self.keyfile, "w") as f:
+                f.write(key)
+
+        response, _ = self.request()
+        self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
+
+
+class TestRateLimiter(TestCase):
+    """
+    Test per-client token buckets with a controllable clock
+    """
+
+    def setUp(self):
+        self.now = 0.0
+        self.limiter = TokenBucketLimiter(
+            rate=2, burst=3, max_clients=2, clock=lambda: self.now
+        )
+
+    def test_burst_then_limited(self):
+        for _ in range(3):
+            self.assertEqual(self.limiter.acquire("a"), 0)
+        self.assertAlmostEqual(self.limiter.acquire("a"), 0.5)
+
+    def test_lazy_refill(self):
+        for _ in range(3):
+            self.limiter.acquire("a")
+
+        self.now += 1
+        self.assertEqual(self.limiter.acquire("a"), 0)
+        self.assertEqual(self.limiter.acquire("a"), 0)
+        self.assertGreater(self.limiter.acquire("a"), 0)
+
+    def test_clients_are_independent(self):
+        for _ in range(3):
+            self.limiter.acquire("a")
+        self.assertEqual(self.limiter.acquire("b"), 0)
+
+    def test_least_recently_seen_client_is_evicted(self):
+        self.limiter.acquire("a")
+        self.limiter.acquire("b")
+        self.limiter.acquire("a")
+        self.limiter.acquire("c")
+
+        self.assertEqual(len(self.limiter.buckets), 2)
+        self.assertIn("a", self.limiter.buckets)
+        self.assertNotIn("b", self.limiter.buckets)
+
+    def test_rate_below_one_allows_a_request(self):
+        limiter = TokenBucketLimiter(rate=0.5, clock=lambda: self.now)
+        self.assertEqual(limiter.acquire("a"), 0)
+        self.assertAlmostEqual(limiter.acquire("a"), 2)
+
+        self.now += 2
+        self.assertEqual(limiter.acquire("a"), 0)
+
+    def test_rate_must_be_positive(self):
+        with self.assertRaises(ValueError):
+            TokenBucketLimiter(rate=0)
+
+    def test_server_responds_too_many_requests(self):
+        server = ThreadedTCPServer(
+            ("localhost", 0),
+            ThreadedTCPRequestHandler,
+            rate_limiter=TokenBucketLimiter(rate=0.1, burst=1),
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        responses = []
+        for _ in range(2):
+            with create_connection(server.server_address) as sock:
+                sock.sendall(bytes(str(Request()), "ascii"))
+                responses.append(Response.deserializer(str(sock.recv(1024), "ascii")))
+
+        server.shutdown()
+        server.server_close()
+
+        self.assertEqual(responses[0].status_code, StatusCode.HTTP_200_OK)
+        self.assertEqual(
+            responses[1].status_code, StatusCode.HTTP_429_TOO_MANY_REQUESTS
+        )
+        self.assertEqual(responses[1].retry_after, "10")
+
+    def test_server_keys_on_header(self):
+        server = ThreadedTCPServer(
+            ("localhost", 0),
+            ThreadedTCPRequestHandler,
+            rate_limiter=TokenBucketLimiter(rate=0.1, burst=1),
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        statuses = []
+        requests = [
+            ("X-Forwarded-For", "1.1.1.1, 10.0.0.1"),
+            ("X-Forwarded-For", "1.1.1.1, 10.0.0.2"),
+            ("X-Forwarded-For", "2.2.2.2"),
+            ("X-Real-IP", "3.3.3.3"),
+            ("X-Real-IP", "3.3.3.3"),
+        ]
+        try:
+            for header, value in requests:
+                ServerDetails.rate_limit_header = header
+                payload = f"GET / HTTP/1.1\r\n{header}: {value}\r\n\r\n"
+                with create_connection(server.server_address) as sock:
+                    sock.sendall(bytes(payload, "ascii"))
+                    response = Response.deserializer(str(sock.recv(1024), "ascii"))
+                    statuses.append(response.status_code)
+        finally:
+            ServerDetails.rate_limit_header = None
+            server.shutdown()
+            server.server_close()
+
+        self.assertEqual(
+            statuses,
+            [
+                StatusCode.HTTP_200_OK,
+                StatusCode.HTTP_429_TOO_MANY_REQUESTS,
+                StatusCode.HTTP_200_OK,
+                StatusCode.HTTP_200_OK,
+                StatusCode.HTTP_429_TOO_MANY_REQUESTS,
+            ],
+        )
+
+
+class RemoteClientHandler(ThreadedTCPRequestHandler):
+    """
+    Handles requests as if they came from another machine
+    """
+
+    def setup(self):
+        self.client_address = ("192.0.2.1", self.client_address[1])
+
+
+class TestTracing(TestCase):
+    """
+    Test request tracing and the traces admin endpoint
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.trace_file = os.path.join(self.directory.name, "traces.jsonl")
+
+        # Keep every request so the spans can be inspected
+        self.tracer = Tracer(sample_rate=1, path=self.trace_file)
+        self.server = ThreadedTCPServer(
+            ("localhost", 0), ThreadedTCPRequestHandler, tracer=self.tracer, admin=True
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.directory.cleanup()
+
+    def request(self, req):
+        with create_connection(self.server.server_address) as sock:
+            sock.sendall(bytes(str(req), "ascii"))
+            return Response.deserializer(str(sock.recv(65536), "ascii"))
+
+    def waitForSpans(self, count):
+        # Spans are finished after the response is sent
+        for _ in range(100):
+            if len(self.tracer.spans) >= count:
+                return
+            time.sleep(0.01)
+
+    def test_span_records_phases(self):
+        self.request(Request(context="test.html"))
+        self.waitForSpans(1)
+
+        span = self.request(Request(context="_admin/traces?route=test.html"))
+        spans = json.loads(span.body)["spans"]
+
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0]["method"], "GET")
+        self.assertEqual(spans[0]["status"], 200)
+        self.assertGreater(spans[0]["bytes_out"], 0)
+        self.assertGreater(spans[0]["recv_count"], 0)
+        for phase in ("queue_wait", "deserialize", "handler", "serialize", "sendall"):
+            self.assertIn(phase, spans[0]["phases"])
+
+    def test_spans_are_written_to_file(self):
+        self.request(Request(context="t.html"))
+        self.waitForSpans(1)
+
+        with open(self.trace_file, "r") as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual(spans[0]["route"], "t.html")
+        self.assertEqual(spans[0]["status"], 404)
+
+    def test_slow_requests_are_always_kept(self):
+        self.tracer.sample_rate = 0
+        self.tracer.slow_threshold_ns = 1_000_000_000
+
+        self.request(Request())
+        self.request(Request(context="delay"))
+        self.waitForSpans(1)
+
+        spans = self.tracer.query()
+        self.assertEqual(len(spans), 1)
+        self.assertEqual(spans[0]["route"], "delay")
+
+    def test_idle_time_is_not_request_time(self):
+        self.tracer.slow_threshold_ns = 500_000_000
+
+        with create_connection(self.server.server_address) as sock:
+            for _ in range(2):
+                sock.sendall(bytes(str(Request()), "ascii"))
+                sock.recv(65536)
+                time.sleep(0.6)
+        self.waitForSpans(2)
+        time.sleep(0.1)
+
+        spans = self.tracer.query()
+        self.assertEqual([span["route"] for span in spans], ["/", "/"])
+        for span in spans:
+            self.assertLess(span["duration_ns"], self.tracer.slow_threshold_ns)
+
+    def test_unknown_admin_path_not_found(self):
+        response = self.request(Request(context="_admin/unknown"))
+        self.assertEqual(response.status_code, StatusCode.HTTP_404_NOT_FOUND)
+
+    def test_admin_is_loopback_only(self):
+        self.assertTrue(isLoopback("127.0.0.1"))
+        self.assertTrue(isLoopback("::1"))
+        self.assertTrue(isLoopback("::ffff:127.0.0.1"))
+        self.assertFalse(isLoopback("192.0.2.1"))
+        self.assertFalse(isLoopback("2001:db8::1"))
+
+        self.server.RequestHandlerClass = RemoteClientHandler
+        response = self.request(Request(context="_admin/traces"))
+        self.assertEqual(response.status_code, StatusCode.HTTP_403_FORBIDDEN)
+
+
+class TestMemory(TestCase):
+    """
+    Test memory diagnostics and their admin endpoints
+    """
+
+    def setUp(self):
+        # Account every request so the route statistics are deterministic
+        self.memory = MemoryDiagnostics(sample_rate=1)
+        self.memory.start()
+        self.server = ThreadedTCPServer(
+            ("localhost", 0), ThreadedTCPRequestHandler, memory=self.memory, admin=True
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.memory.stop()
+
+    def request(self, req):
+        # Read until the server closes the connection
+        req.connection = "close"
+
+        with create_connection(self.server.server_address) as sock:
+            sock.sendall(bytes(str(req), "ascii"))
+            data = b""
+            while chunk := sock.recv(65536):
+                data += chunk
+            return Response.deserializer(str(data, "ascii"))
+
+    def test_summary_reports_routes(self):
+        self.request(Request(context="test.html"))
+
+        # The route is accounted after the response is sent
+        for _ in range(100):
+            if "test.html" in self.memory.routes:
+                break
+            time.sleep(0.01)
+
+        summary = json.loads(self.request(Request(context="_admin/memory")).body)
+        self.assertEqual(summary["routes"]["test.html"]["sampled"], 1)
+        self.assertGreater(summary["routes"]["test.html"]["max_bytes"], 0)
+        self.assertTrue(summary["tracemalloc"]["tracing"])
+        self.assertIn("requests", summary["live"])
+
+    def test_closed_connection_is_not_accounted(self):
+        with create_connection(self.server.server_address) as sock:
+            sock.sendall(bytes(str(Request()), "ascii"))
+            sock.recv(65536)
+        time.sleep(0.1)
+
+        self.assertEqual(list(self.memory.routes), ["/"])
+
+    def test_snapshot_diff(self):
+        first = self.request(Request(context="_admin/memory/snapshot?limit=5"))
+        second = self.request(Request(context="_admin/memory/snapshot?limit=5"))
+
+        self.assertFalse(json.loads(first.body)["compared"])
+        self.assertTrue(json.loads(second.body)["compared"])
+        self.assertLessEqual(len(json.loads(second.body)["top"]), 5)
+
+    def test_one_request_sampled_at_a_time(self):
+        started_with = self.memory.begin_request()
+        self.assertIsNotNone(started_with)
+        self.assertIsNone(self.memory.begin_request())
+
+        self.memory.end_request("a", started_with)
+        started_with = self.memory.begin_request()
+        self.assertIsNotNone(started_with)
+        self.memory.end_request("b", started_with)
+
+        self.assertEqual(self.memory.routes["a"][0], 1)
+        self.assertEqual(self.memory.routes["b"][0], 1)
+
+    def test_live_messages_counted(self):
+        responses = [Response() for _ in range(3)]
+        self.assertGreaterEqual(self.memory.live_messages()["responses"], 3)
+        del responses
+
+
+class TestVirtualHosts(TestCase):
+    """
+    Test routing requests to virtual hosts by their Host header
+    """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.sites = {}
+        for name in ("example", "blog", "fallback"):
+            root = os.path.join(self.directory.name, name)
+            os.mkdir(root)
+            with open(os.path.join(root, "index.html"), "w") as f:
+                f.write(name)
+            self.sites[name] = VirtualHost(name, root)
+
+        self.router = VirtualHostRouter(default=self.sites["fallback"])
+        self.router.add("example.com", self.sites["example"])
+        self.router.add("*.blog.example.com", self.sites["blog"])
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_exact_host(self):
+        self.assertIs(self.router.lookup("example.com"), self.sites["example"])
+        self.assertIs(self.router.lookup("EXAMPLE.com:9999"), self.sites["example"])
+
+    def test_wildcard_host(self):
+        self.assertIs(self.router.lookup("a.blog.example.com"), self.sites["blog"])
+        self.assertIs(self.router.lookup("a.b.blog.example.com"), self.sites["blog"])
+        self.assertIs(self.router.lookup("blog.example.com"), self.sites["fallback"])
+
+    def test_unknown_host_without_default(self):
+        router = VirtualHostRouter()
+        router.add("example.com", self.sites["example"])
+        self.assertIsNone(router.lookup("example.org"))
+
+    def test_resolve_stays_in_document_root(self):
+        vhost = self.sites["example"]
+        self.assertEqual(
+            vhost.resolve("index.html"),
+            os.path.join(vhost.document_root, "index.html"),
+        )
+        self.assertIsNone(vhost.resolve("../blog/index.html"))
+
+    def test_server_serves_per_host_document_root(self):
+        self.sites["blog"].routes["index.html"] = lambda req: Response(body="route")
+
+        server = ThreadedTCPServer(
+            ("localhost", 0), ThreadedTCPRequestHandler, vhosts=self.router
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        bodies = {}
+        for host in ("example.com", "x.blog.example.com", "other.com"):
+            with create_connection(server.server_address) as sock:
+                req = Request(context="index.html", Host=host)
+                sock.sendall(bytes(str(req), "ascii"))
+                bodies[host] = Response.deserializer(str(sock.recv(1024), "ascii")).body
+
+        server.shutdown()
+        server.server_close()
+
+        self.assertEqual(
+            bodies,
+            {
+                "example.com": "example",
+                "x.blog.example.com": "route",
+                "other.com": "fallback",
+            },
+        )
+
+    def test_host_header_any_case(self):
+        router = VirtualHostRouter()
+        router.add("example.com", self.sites["example"])
+
+        server = ThreadedTCPServer(
+            ("localhost", 0), ThreadedTCPRequestHandler, vhosts=router
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        with create_connection(server.server_address) as sock:
+            sock.sendall(b"GET /index.html HTTP/1.1\r\nhost: example.com\r\n\r\n")
+            response = Response.deserializer(str(sock.recv(1024), "ascii"))
+
+        server.shutdown()
+        server.server_close()
+
+        self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
+        self.assertEqual(response.body, "example")
+
+    def test_head_response_has_no_body(self):
+        self.sites["blog"].routes["index.html"] = lambda req: Response(body="route")
+
+        server = ThreadedTCPServer(
+            ("localhost", 0), ThreadedTCPRequestHandler, vhosts=self.router
+        )
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+
+        # Pipelined, so a HEAD body would be read as the start of the GET response
+        host = "x.blog.example.com"
+        head = Request(method=Methods.HTTP_HEAD, context="index.html", Host=host)
+        get = Request(context="index.html", Host=host, Connection="close")
+        with create_connection(server.server_address) as sock:
+            sock.sendall(bytes(str(head) + str(get), "ascii"))
+            data = b""
+            while chunk := sock.recv(1024):
+                data += chunk
+
+        server.shutdown()
+        server.server_close()
+
+        first, second = data.split(b"HTTP/1.1 ")[1:]
+        self.assertTrue(first.endswith(b"\r\n\r\n"))
+        self.assertTrue(second.endswith(b"\r\n\r\nroute"))
+
+
+class TestReverseProxy(TestCase):
+    """
+    Test proxying to upstream instances of this server
+    """
+
+    def setUp(self):
+        self.upstream_servers = {}
+        for name in ("a", "b"):
+            routes = {
+                "whoami": lambda req, name=name: Response(body=name),
+                "echo": lambda req: Response(body=str(req.body_stream.read(), "ascii")),
+            }
+            server = ThreadedTCPServer(
+                ("localhost", 0),
+                ThreadedTCPRequestHandler,
+                vhosts=VirtualHostRouter(default=VirtualHost(name, ".", routes)),
+            )
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.upstream_servers[name] = server
+
+        self.upstreams = {
+            name: Upstream(*server.server_address, read_timeout=1)
+            for name, server in self.upstream_servers.items()
+        }
+        self.proxy = ReverseProxy(
+            "api/",
+            list(self.upstreams.values()),
+            max_failures=1,
+            health_check_interval=0,
+        )
+        self.server = ThreadedTCPServer(
+            ("localhost", 0), ThreadedTCPRequestHandler, proxies=[self.proxy]
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        # Close the proxy's pooled connections before the upstreams wait on them
+        for server in [self.server, *self.upstream_servers.values()]:
+            server.shutdown()
+            server.server_close()
+
+    def request(self, req):
+        req.connection = "close"
+
+        with create_connection(self.server.server_address) as sock:
+            sock.sendall(bytes(str(req), "ascii"))
+            data = b""
+            while chunk := sock.recv(65536):
+                data += chunk
+            return Response.deserializer(str(data, "ascii"))
+
+    def test_round_robin_over_pooled_connections(self):
+        bodies = [self.request(Request(context="api/whoami")).body for _ in range(6)]
+
+        self.assertEqual(bodies, ["a", "b"] * 3)
+        for upstream in self.upstreams.values():
+            self.assertEqual(upstream.connections_opened, 1)
+
+    def test_least_connections(self):
+        self.proxy.strategy = "least_connections"
+        self.upstreams["a"].active = 2
+        self.assertIs(self.proxy.choose(), self.upstreams["b"])
+
+    def test_streams_file_body(self):
+        response = self.request(Request(context="api/test.html"))
+
+        with open("test.html", "r") as f:
+            expected_response_body = "\r\n".join(f.read().splitlines())
+
+        self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
+        self.assertEqual(response.body, expected_response_body)
+
+    def test_head_has_no_body(self):
+        response = self.request(
+            Request(method=Methods.HTTP_HEAD, context="api/test.html")
+        )
+
+        self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
+        self.assertEqual(response.content_length, str(Path("test.html").stat().st_size))
+        self.assertEqual(response.body, "")
+
+    def test_streams_request_body(self):
+        content = "x" * (256 * 1024)
+        headers = {"Content-Type": "text/plain", "Content-Length": len(content)}
+
+        req = Request(
+            method=Methods.HTTP_POST, context="api/echo", body=content, **headers
+        )
+        response = self.request(req)
+
+        self.assertEqual(response.status_code, StatusCode.HTTP_200_OK)
+        self.assertEqual(response.body, content)
+
+    def test_failed_upstream_is_ejected(self):
+        self.upstream_servers["b"].shutdown()
+        self.upstream_servers["b"].server_close()
+
+        bodies = [self.request(Request(context="api/whoami")).body for _ in range(4)]
+
+        self.assertEqual(bodies, ["a"] * 4)
+        self.assertFalse(self.upstreams["b"].is_available(time.monotonic()))
+
+    def test_no_available_upstream(self):
+        for upstream in self.upstreams.values():
+            upstream.eject(60)
+
+        response = self.request(Request(context="api/whoami"))
+        self.assertEqual(response.status_code, StatusCode.HTTP_503_SERVICE_UNAVAILABLE)
+
+    def test_upstream_timeout(self):
+        response = self.request(Request(context="api/delay"))
+        self.assertEqual(response.status_code, StatusCode.HTTP_504_GATEWAY_TIMEOUT)
+
+
+class StdlibUpstreamHandler(BaseHTTPRequestHandler):
+    """
+    An upstream with statuses and headers this server doesn't know about
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    # Close idle connections soon, so pooled ones go stale
+    timeout = 0.5
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, code, body=b"", headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/redirect":
+            self.reply(302, headers=[("Location", "/elsewhere")])
+        elif self.path == "/created":
+            self.reply(201, b"made")
+        elif self.path == "/headers":
+            received = {
+                name: self.headers.get(name)
+                for name in ("Authorization", "Cookie", "X-Hop", "Connection")
+            }
+            self.reply(
+                200,
+                bytes(json.dumps(received), "ascii"),
+                [
+                    ("Cache-Control", "no-store"),
+                    ("Set-Cookie", "a=1"),
+                    ("Set-Cookie", "b=2"),
+                    ("Connection", "X-Hop"),
+                    ("X-Hop", "secret"),
+                ],
+            )
+        elif self.path == "/chunked":
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for chunk in (b"hello", b" ", b"x" * 70000):
+                self.wfile.write(b"%x;ext=1\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.write(b"0\r\nX-Trailer: 1\r\n\r\n")
+        else:
+            self.reply(404)
+
+    def do_POST(self):
+        self.reply(200, self.rfile.read(int(self.headers["Content-Length"])))
+
+
+class TestProxyPassthrough(TestCase):
+    """
+    Test that statuses and headers are passed through the proxy as they are
+    """
+
+    def setUp(self):
+        self.upstream_server = ThreadingHTTPServer(
+            ("localhost", 0), StdlibUpstreamHandler
+        )
+        threading.Thread(target=self.upstream_server.serve_forever, daemon=True).start()
+
+        self.upstream = Upstream(*self.upstream_server.server_address, read_timeout=2)
+        self.proxy = ReverseProxy("api/", [self.upstream], health_check_interval=0)
+        self.server = ThreadedTCPServer(
+            ("localhost", 0), ThreadedTCPRequestHandler, proxies=[self.proxy]
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.upstream_server.shutdown()
+        self.upstream_server.server_close()
+
+    def request(self, context, headers=(), connection="close", method="GET", body=""):
+        """
+        Make a request, returns the status line, headers and body
+        """
+        lines = [
+            f"{method} {context} HTTP/1.1",
+            "Host: localhost",
+            f"Connection: {connection}",
+        ]
+        lines += [f"{name}: {value}" for name, value in headers]
+        if body:
+            lines.append(f"Content-Length: {len(body)}")
+
+        with create_connection(self.server.server_address) as sock:
+            sock.sendall(bytes("\r\n".join(lines) + "\r\n\r\n" + body, "ascii"))
+            data = b""
+            while chunk := sock.recv(65536):
+                data += chunk
+
+        head, _, body = data.partition(b"\r\n\r\n")
+        status_line, *header_lines = str(head, "ascii").split("\r\n")
+        return status_line, [tuple(h.split(": ", 1)) for h in header_lines], body
+
+    def test_unknown_statuses_pass_through(self):
+        for _ in range(4):
+            status_line, headers, _ = self.request("/api/redirect")
+            self.assertEqual(status_line, "HTTP/1.1 302 Found")
+            self.assertIn(("Location", "/elsewhere"), headers)
+
+        status_line, _, body = self.request("/api/created")
+        self.assertEqual(status_line, "HTTP/1.1 201 Created")
+        self.assertEqual(body, b"made")
+
+        # Well-formed responses are never failures
+        self.assertTrue(self.upstream.is_available(time.monotonic()))
+        self.assertEqual(self.upstream.failures, 0)
+
+    def test_end_to_end_headers_pass_through(self):
+        status_line, headers, body = self.request(
+            "/api/headers",
+            [("Authorization", "Bearer token"), ("Cookie", "c=3"), ("X-Hop", "1")],
+            connection="close, X-Hop",
+        )
+
+        self.assertEqual(status_line, "HTTP/1.1 200 OK")
+        self.assertEqual(
+            json.loads(body),
+            {
+                "Authorization": "Bearer token",
+                "Cookie": "c=3",
+                "X-Hop": None,
+                "Connection": "keep-alive",
+            },
+        )
+        self.assertIn(("Cache-Control", "no-store"), headers)
+        self.assertIn(("Set-Cookie", "a=1"), headers)
+        self.assertIn(("Set-Cookie", "b=2"), headers)
+        self.assertNotIn("X-Hop", [name for name, _ in headers])
+
+    def test_chunked_body_is_decoded(self):
+        for _ in range(2):
+            start = time.monotonic()
+            status_line, headers, body = self.request("/api/chunked")
+
+            self.assertEqual(status_line, "HTTP/1.1 200 OK")
+            self.assertEqual(body, b"hello " + b"x" * 70000)
+            self.assertNotIn("Transfer-Encoding", [name for name, _ in headers])
+            # Not waiting for the upstream to time out or close the connection
+            self.assertLess(time.monotonic() - start, 0.5)
+
+        self.assertEqual(self.upstream.connections_opened, 1)
+
+    def test_stale_pooled_connection_is_replaced(self):
+        self.request("/api/created")
+        time.sleep(1)
+
+        status_line, _, body = self.request("/api/echo", method="POST", body="once")
+
+        self.assertEqual(status_line, "HTTP/1.1 200 OK")
+        self.assertEqual(body, b"once")
+        self.assertEqual(self.upstream.connections_opened, 2)
+
+    def test_only_idempotent_requests_are_sent_again(self):
+        # An upstream that reads each request, then resets the connection
+        listener = create_server(("localhost", 0))
+        received = []
+
+        def serve():
+            while True:
+                try:
+                    sock, _ = listener.accept()
+                except OSError:
+                    return
+                received.append(sock.recv(65536).split(b" ", 1)[0])
+                sock.setsockopt(SOL_SOCKET, SO_LINGER, struct.pack("ii", 1, 0))
+                sock.close()
+
+        threading.Thread(target=serve, daemon=True).start()
+        proxy = ReverseProxy(
+            "", [Upstream(*listener.getsockname())], health_check_interval=0
+        )
+
+        headers = {"Content-Type": "text/plain", "Content-Length": "2"}
+        post = proxy.handle(Request(method=Methods.HTTP_POST, body="hi", **headers))
+        get = proxy.handle(Request())
+        listener.close()
+
+        self.assertEqual(post.status_code, StatusCode.HTTP_502_BAD_GATEWAY)
+        self.assertEqual(get.status_code, StatusCode.HTTP_502_BAD_GATEWAY)
+        self.assertEqual(received, [b"POST", b"GET", b"GET"])
+
+
+class TestCapture(TestCase):
+    """
+    Test recording traffic and replaying it
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "capture.jsonl")
+
+        routes = {
+            "echo": lambda req: Response(body=str(req.body_stream.read(), "ascii")),
+        }
+        self.server = ThreadedTCPServer(
+            ("localhost", 0),
+            ThreadedTCPRequestHandler,
+            vhosts=VirtualHostRouter(default=VirtualHost("capture", ".", routes)),
+            capture=TrafficCapture(self.path, max_body=4),
+        )
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+
+    def request(self, req):
+        req.connection = "close"
+
+        with create_connection(self.server.server_address) as sock:
+            sock.sendall(bytes(str(req), "ascii"))
+            while sock.recv(65536):
+                pass
+
+    def echo(self):
+        headers = {"Content-Type": "text/plain", "Content-Length": 5}
+        return Request(
+            method=Methods.HTTP_POST, context="echo", body="hello", **headers
+        )
+
+    @staticmethod
+    def record(t, head, status):
+        return {"t": t, "head": head, "body": "", "body_length": 0, "status": status}
+
+    def test_capture(self):
+        self.request(self.echo())
+        self.request(Request(context="missing.html"))
+        self.server.capture.close()
+
+        records = load_capture(self.path)
+        self.assertEqual([r["status"] for r in records], [200, 404])
+        self.assertTrue(records[0]["head"].startswith("POST echo "))
+        # Bodies are cut at max_body, keeping the original length
+        self.assertEqual(base64.b64decode(records[0]["body"]), b"hell")
+        self.assertEqual(records[0]["body_length"], 5)
+        self.assertLessEqual(records[0]["t"], records[1]["t"])
+
+    def test_capture_replaces_earlier_run(self):
+        self.request(Request(context="missing.html"))
+        self.server.capture.close()
+
+        self.server.capture = TrafficCapture(self.path)
+        self.request(self.echo())
+        self.server.capture.close()
+
+        records = load_capture(self.path)
+        self.assertEqual([r["status"] for r in records], [200])
+
+    def test_replay(self):
+        for _ in range(5):
+            self.request(self.echo())
+            self.request(Request(context="missing.html"))
+        records = load_capture(self.path)
+
+        results, elapsed = replay(
+            records, self.server.server_address, max_speed=True, connections=2
+        )
+        summary = summarize(results, elapsed)
+
+        self.assertEqual(summary["requests"], 10)
+        self.assertEqual(summary["statuses"], {200: 5, 404: 5})
+        self.assertFalse(summary["differences"])
+
+    def test_replay_skips_interim_responses(self):
+        records = [
+            {
+                "t": 0,
+                "head": "POST echo HTTP/1.1\r\nContent-Type: text/plain\r\n"
+                "Content-Length: 5\r\nExpect: 100-continue",
+                "body": str(base64.b64encode(b"hello"), "ascii"),
+                "body_length": 5,
+                "status": 200,
+            },
+            self.record(1, "GET missing.html HTTP/1.1", 404),
+        ]
+
+        results, _ = replay(records, self.server.server_address, connections=1)
+        self.assertEqual([r["status"] for r in results], [200, 404])
+
+    def test_replay_survives_malformed_responses(self):
+        listener = create_server(("localhost", 0))
+
+        def serve():
+            while True:
+                try:
+                    sock, _ = listener.accept()
+                except OSError:
+                    return
+                with sock:
+                    sock.recv(65536)
+                    sock.sendall(b"nonsense\r\n\r\n")
+
+        threading.Thread(target=serve, daemon=True).start()
+
+        records = [self.record(0, "GET / HTTP/1.1", 200)] * 4
+        results = []
+        thread = threading.Thread(
+            target=lambda: results.extend(
+                replay(records, listener.getsockname(), max_speed=True, connections=1)[
+                    0
+                ]
+            ),
+            daemon=True,
+        )
+        thread.start()
+        thread.join(5)
+        listener.close()
+
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([r["status"] for r in results], [None] * 4)
+
+
 if __name__ == "__main__":
     main()
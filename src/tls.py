@@ -0,0 +1,137 @@
+import logging
+import os
+import ssl
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+
+class TLSConfig:
+    """
+    Owns the server-side SSL context
+    NOTE: Certificates are reloaded into the same context, so session tickets
+    issued before a reload can still be used to resume afterwards
+    """
+
+    def __init__(
+        self,
+        certfile: str,
+        keyfile: str = None,
+        alpn_protocols: list = None,
+        num_tickets: int = 2,
+        reload_interval: float = 5.0,
+    ) -> None:
+        self.certfile = certfile
+        self.keyfile = keyfile
+        self.alpn_protocols = alpn_protocols or ["http/1.1"]
+        self.num_tickets = num_tickets
+        self.reload_interval = reload_interval
+
+        self.context = self.create_context()
+        self.loaded_mtimes = self.get_certificate_mtimes()
+
+    def create_context(self) -> ssl.SSLContext:
+        """
+        Build a server context with ALPN and session resumption enabled
+        """
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.minimum_version = ssl.TLSVersion.TLSv1_2
+
+        # TLS 1.3 resumption uses tickets sent after the handshake,
+        # TLS 1.2 uses tickets or the server-side session cache (both on by default)
+        context.num_tickets = self.num_tickets
+        context.options &= ~ssl.OP_NO_TICKET
+
+        if ssl.HAS_ALPN:
+            context.set_alpn_protocols(self.alpn_protocols)
+
+        context.load_cert_chain(self.certfile, self.keyfile)
+        return context
+
+    def get_certificate_mtimes(self) -> tuple:
+        """
+        Get last modified times of the certificate and key files
+        """
+        paths = [p for p in (self.certfile, self.keyfile) if p]
+        try:
+            return tuple(os.stat(p).st_mtime_ns for p in paths)
+        except OSError:
+            return ()
+
+    def reload_certificate(self) -> None:
+        """
+        Load the certificate chain again into the existing context
+        New handshakes use the new certificate, established connections are unaffected
+        NOTE: Loading isn't atomic, so the files are checked in a scratch context first
+        and a bad certificate or key never replaces the working one
+        """
+        # Files changing during the reload are picked up again on the next check
+        mtimes = self.get_certificate_mtimes()
+
+        ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER).load_cert_chain(
+            self.certfile, self.keyfile
+        )
+        self.context.load_cert_chain(self.certfile, self.keyfile)
+        self.loaded_mtimes = mtimes
+
+    def try_reload_certificate(self) -> bool:
+        """
+        Reload the certificate chain, keeping the current one if the files are invalid
+        """
+        try:
+            self.reload_certificate()
+        except (OSError, ssl.SSLError) as e:
+            logger.warning("Keeping the current certificate, reload failed: %s", e)
+            return False
+        return True
+
+    def reload_certificate_if_changed(self) -> bool:
+        """
+        Reload the certificate chain if either file changed on disk
+        """
+        mtimes = self.get_certificate_mtimes()
+        if not mtimes or mtimes == self.loaded_mtimes:
+            return False
+
+        # Files may be half-written, if so they're tried again on the next check
+        return self.try_reload_certificate()
+
+    def wrap_listening_socket(self, sock) -> ssl.SSLSocket:
+        """
+        Wrap the listening socket so that accepted connections are TLS sockets
+        NOTE: The handshake is deferred so it runs in the worker thread, not in accept()
+        """
+        return self.context.wrap_socket(
+            sock, server_side=True, do_handshake_on_connect=False
+        )
+
+
+def create_self_signed_certificate(
+    certfile: str, keyfile: str, hostname: str = "localhost"
+) -> None:
+    """
+    Generate a self-signed certificate for local testing and benchmarking
+    NOTE: Requires the openssl command line tool
+    """
+    subprocess.run(
+        [
+            "openssl",
+            "req",
+            "-x509",
+            "-newkey",
+            "rsa:2048",
+            "-nodes",
+            "-days",
+            "1",
+            "-subj",
+            f"/CN={hostname}",
+            "-addext",
+            f"subjectAltName=DNS:{hostname}",
+            "-keyout",
+            keyfile,
+            "-out",
+            certfile,
+        ],
+        check=True,
+        capture_output=True,
+    )
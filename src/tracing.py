@@ -0,0 +1,178 @@
+import json
+import logging
+import random
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from logging.handlers import RotatingFileHandler
+from time import perf_counter_ns, time_ns
+
+
+class Span:
+    """
+    Timestamps the phases of a single request
+    NOTE: Phase durations are in nanoseconds, from perf_counter_ns()
+    """
+
+    # Keep the first few recv() calls, large bodies are summarized by the totals
+    max_recvs = 32
+
+    def __init__(self) -> None:
+        self.accepted_ns = perf_counter_ns()
+        self.accepted_at = time_ns()
+        self.duration_ns = 0
+        self.phases = {}
+        self.recvs = []
+        self.recv_count = 0
+
+        self.method = ""
+        self.route = ""
+        self.status = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @contextmanager
+    def phase(self, name: str):
+        start = perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + perf_counter_ns() - start
+
+    def mark_started(self) -> None:
+        """
+        Record the time between accept() and the handler starting
+        """
+        waited = perf_counter_ns() - self.accepted_ns
+        self.phases["queue_wait"] = waited - self.phases.get("tls_handshake", 0)
+
+    def record_recv(self, start_ns: int, size: int) -> None:
+        self.recv_count += 1
+        self.bytes_in += size
+        if len(self.recvs) < self.max_recvs:
+            self.recvs.append((perf_counter_ns() - start_ns, size))
+
+    def to_dict(self) -> dict:
+        return {
+            "accepted_at": self.accepted_at,
+            "duration_ns": self.duration_ns,
+            "method": self.method,
+            "route": self.route,
+            "status": self.status,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "phases": self.phases,
+            "recv_count": self.recv_count,
+            "recvs": self.recvs,
+        }
+
+
+class NullSpan:
+    """
+    Stands in for a span when the request isn't traced
+    """
+
+    phases = {}
+    method = route = ""
+    status = bytes_in = bytes_out = 0
+
+    @staticmethod
+    def phase(name: str):
+        return nullcontext()
+
+    def mark_started(self) -> None:
+        pass
+
+    def record_recv(self, start_ns: int, size: int) -> None:
+        pass
+
+    def __setattr__(self, name, value) -> None:
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer:
+    """
+    Collects finished spans into a ring buffer and, optionally, a rotating JSON-lines
+    file
+    NOTE: Sampling is decided once the request finishes, so slow ones are always kept
+    """
+
+    def __init__(
+        self,
+        sample_rate: float = 0.01,
+        slow_threshold_ms: float = 500,
+        buffer_size: int = 1024,
+        path: str = None,
+        max_bytes: int = 10 * 1024 * 1024,
+        backup_count: int = 3,
+    ) -> None:
+        self.sample_rate = sample_rate
+        self.slow_threshold_ns = int(slow_threshold_ms * 1_000_000)
+        self.spans = deque(maxlen=buffer_size)
+        self.lock = threading.Lock()
+
+        self.logger = None
+        if path:
+            self.logger = logging.getLogger(f"{__name__}.{id(self)}")
+            self.logger.propagate = False
+            self.logger.setLevel(logging.INFO)
+            self.logger.addHandler(
+                RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+            )
+
+    def start_span(self) -> Span:
+        return Span()
+
+    def finish(self, span: Span) -> bool:
+        """
+        Keep the span if it's slow or sampled
+        Returns whether the span was kept
+        """
+        span.duration_ns = perf_counter_ns() - span.accepted_ns
+
+        if span.duration_ns < self.slow_threshold_ns and (
+            random.random() >= self.sample_rate
+        ):
+            return False
+
+        record = span.to_dict()
+        with self.lock:
+            self.spans.append(record)
+
+        if self.logger:
+            self.logger.info(json.dumps(record))
+
+        return True
+
+    def query(
+        self,
+        min_duration_ms: float = 0,
+        route: str = None,
+        status: int = None,
+        limit: int = 100,
+    ) -> list:
+        """
+        Get the most recent spans matching the filters, newest first
+        """
+        min_duration_ns = min_duration_ms * 1_000_000
+
+        with self.lock:
+            spans = list(self.spans)
+
+        matches = []
+        for span in reversed(spans):
+            if span["duration_ns"] < min_duration_ns:
+                continue
+            if route is not None and span["route"] != route:
+                continue
+            if status is not None and span["status"] != status:
+                continue
+
+            matches.append(span)
+            if len(matches) >= limit:
+                break
+
+        return matches
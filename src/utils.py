@@ -1,5 +1,9 @@
+import os
+import time
 import pathlib
 import datetime
+import threading
+from collections import OrderedDict
 
 
 class DateUtilsBase:
@@ -45,5 +49,69 @@ class FileUtilsBase:
         return DateUtilsBase.get_http_date(timestamp)
 
 
+class FileMetadataCacheBase:
+    """
+    Caches stat() results so repeated HEAD and revalidation requests skip the filesystem
+    NOTE: Entries may be up to ttl seconds stale, a ttl of 0 disables caching
+    """
+
+    def __init__(self, ttl: float = 1.0, max_entries: int = 1024) -> None:
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def stat(self, path: str, namespace: str = "") -> os.stat_result:
+        """
+        Get file metadata, raises like os.stat() if the file doesn't exist
+        Entries are kept per namespace, e.g. per virtual host
+        """
+        key = (namespace, path)
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                return entry[1]
+
+        result = os.stat(path)
+
+        if self.ttl > 0:
+            with self.lock:
+                self.entries[key] = (now, result)
+                self.entries.move_to_end(key)
+                if len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+
+        return result
+
+
+class FileBody:
+    """
+    Streams the first length bytes of an open file in chunks
+    NOTE: The server closes the body once sent, which closes the file
+    """
+
+    def __init__(self, file, length: int, chunk_size: int = 64 * 1024) -> None:
+        self.file = file
+        self.length = length
+        self.chunk_size = chunk_size
+
+    def __iter__(self):
+        remaining = self.length
+        while remaining > 0:
+            chunk = self.file.read(min(remaining, self.chunk_size))
+            if not chunk:
+                # Content-Length was sent already, all that's left is to drop the client
+                raise ConnectionError("File truncated while sending it")
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        self.file.close()
+
+
 DateUtils = DateUtilsBase()
 FileUtils = FileUtilsBase()
+FileMetadataCache = FileMetadataCacheBase()
@@ -0,0 +1,115 @@
+import json
+import os
+import threading
+
+
+class VirtualHost:
+    """
+    A site served by this process, with its own document root and routes
+    NOTE: The name doubles as the namespace for the site's cache entries
+    """
+
+    def __init__(self, name: str, document_root: str, routes: dict = None) -> None:
+        self.name = name
+        self.document_root = os.path.abspath(document_root)
+
+        # Context -> handler taking a request and returning a response
+        self.routes = routes or {}
+
+    def resolve(self, context: str) -> str:
+        """
+        Map a request context to a path under the document root
+        Returns None if the context would escape the document root
+        """
+        path = os.path.normpath(os.path.join(self.document_root, context.lstrip("/")))
+        if os.path.commonpath([self.document_root, path]) != self.document_root:
+            return None
+        return path
+
+
+class VirtualHostRouter:
+    """
+    Routes Host header values to virtual hosts
+    Exact names are looked up directly, wildcards like *.example.com by their suffix
+    """
+
+    # Resolved Host headers to remember, the cache is reset when it fills up
+    max_cached = 4096
+
+    def __init__(self, default: VirtualHost = None) -> None:
+        self.default = default
+        self.exact = {}
+        self.wildcards = {}
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def add(self, pattern: str, vhost: VirtualHost) -> None:
+        pattern = pattern.lower()
+        if pattern.startswith("*."):
+            self.wildcards[pattern[2:]] = vhost
+        else:
+            self.exact[pattern] = vhost
+
+        with self.lock:
+            self.cache.clear()
+
+    @staticmethod
+    def normalize(host: str) -> str:
+        """
+        Lower-case the Host header value and remove its port
+        """
+        host = host.strip().lower().rstrip(".")
+        if host.startswith("["):
+            # IPv6 literal, e.g. [::1]:9999
+            return host[: host.find("]") + 1]
+        return host.split(":", 1)[0]
+
+    def lookup(self, host: str) -> VirtualHost:
+        """
+        Get the virtual host serving a Host header value, or the default if none match
+        """
+        vhost = self.cache.get(host)
+        if vhost:
+            return vhost
+
+        name = self.normalize(host)
+        vhost = self.exact.get(name)
+
+        if not vhost and self.wildcards:
+            # Longest suffix first, a.b.example.com -> b.example.com -> example.com
+            labels = name.split(".")
+            for i in range(1, len(labels)):
+                vhost = self.wildcards.get(".".join(labels[i:]))
+                if vhost:
+                    break
+
+        vhost = vhost or self.default
+        if vhost:
+            with self.lock:
+                if len(self.cache) >= self.max_cached:
+                    self.cache.clear()
+                self.cache[host] = vhost
+
+        return vhost
+
+    @staticmethod
+    def from_file(path: str) -> "VirtualHostRouter":
+        """
+        Load virtual hosts from a JSON file mapping host patterns to document roots
+        e.g. {"example.com": "/srv/a", "*.example.org": "/srv/b", "default": "."}
+        Relative document roots are relative to the file
+        """
+        with open(path, "r") as f:
+            config = json.load(f)
+
+        base = os.path.dirname(os.path.abspath(path))
+        router = VirtualHostRouter()
+
+        for pattern, document_root in config.items():
+            vhost = VirtualHost(pattern, os.path.join(base, document_root))
+            if pattern == "default":
+                router.default = vhost
+            else:
+                router.add(pattern, vhost)
+
+        return router